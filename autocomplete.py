@@ -1,89 +1,35 @@
 import numpy as np
-import copy
 
 import collections
 import time
-prev_time = dict()
-runtime = collections.defaultdict(int)
-def atime(i):
-    global prev_time
-    #prev_time[i] = time.time()
-    pass
-def btime(i):
-    #runtime[i] += time.time() - prev_time[i]
-    pass
 
-config = __import__('jazz')
-
-def transitions(harmony):
-    chord, key = harmony.split('|')
-    return config._transitions[key][chord]
+from graph import compile_style
+from beat import freeze
+from cache import LRUCache
+from pitchclass import NOTE_BITS, POPCOUNT, contains, in_notes, pcs_of
+# stage timers, no-ops until timing.enable() is called
+from timing import start as atime, stop as btime
 
-def notes_fn(harmony):
-    chord, key = harmony.split('|')
-    return {
-        (config._keys[key] + note) % 12
-        for note in config._notes[key][chord]
-    } if chord in config._notes[key] else []
-
-def apply_transition(key, transition):
-    atime('apply_transition')
-    key = key.split('|')[-1]
-    if '|' in transition:
-        new_chord, key_change = transition.split('|')
-        retval = "{}|{}".format(new_chord, config._key_change(key, key_change))
-    else:
-        retval = "{}|{}".format(transition, key)
-    btime('apply_transition')
-    return retval
-
-all_chords = {
-    chord
-    for key in config._keys
-    for chord in config._transitions[key]
-}
-harmonies = {
-    "{}|{}".format(chord, key)
-    for chord in all_chords
-    for key in config._keys
-}
-notes = {
-    harmony: notes_fn(harmony)
-    for harmony in harmonies
-}
-dissonance = {
-    harmony: config._dissonance(harmony)
-    for harmony in harmonies
-}
+config = __import__('jazz')
+graph = compile_style(config)
 
 def autocomplete_config(name):
     global config
-    global all_chords
-    global harmonies
-    global notes
-    global dissonance
+    global graph
     config = __import__(name)
-    all_chords = {
-        chord
-        for key in config._keys
-        for chord in config._transitions[key]
-    }
-    harmonies = {
-        "{}|{}".format(chord, key)
-        for chord in all_chords
-        for key in config._keys
-    }
-    notes = {
-        harmony: notes_fn(harmony)
-        for harmony in harmonies
-    }
-    dissonance = {
-        harmony: config._dissonance(harmony)
-        for harmony in harmonies
-    }
-
-
-np.random.seed()
+    graph = compile_style(config)
+    harmony_cache.clear()
+    voicing_cache.clear()
+    joint_cache.clear()
+    backward_cache.clear()
+
+# Random stream for autocompleting one beat. Seeded from the session seed and
+# the beat index, so a beat comes out the same whichever process computes it
+# and a session can be replayed; seed None falls back to the global state.
+def beat_rng(seed, beat_index):
+    if seed is None:
+        return np.random
+    return np.random.RandomState([seed, beat_index])
 
 def get_first(notes):
     for note in notes:
@@ -111,28 +57,163 @@ def get_voice(notes):
                         return notes[i * j]
         return 60
 
-def enumerate_paths(data, idx, harmony):
-    if idx >= len(data):
-        return [([], 0)]
-    chord, key = harmony.split('|')
+def segment_logsumexp(values, indptr):
+    # log(sum(exp(values[indptr[i]:indptr[i + 1]]))) for every row i of a
+    # CSR table, -inf for rows without entries. Reduces along the first axis
+    # of values only.
+    out = np.full((len(indptr) - 1,) + values.shape[1:], -np.inf)
+    counts = np.diff(indptr)
+    rows = counts > 0
+    starts = indptr[:-1][rows]
+    m = np.maximum.reduceat(values, starts)
+    m[~np.isfinite(m)] = 0
+    with np.errstate(divide='ignore'):
+        out[rows] = m + np.log(np.add.reduceat(np.exp(values - np.repeat(m, counts[rows], axis=0)), starts))
+    return out
+
+def harmony_costs(data, idx):
+    # cost of being at each harmony id on beat idx
     beat = data[idx]
-    if 'harmony' in beat and harmony != beat['harmony']:
-        return [(harmony, float('inf'))]
-    # dissonance coefficient
-    coeff = -1. * beat['dissonance'] if 'dissonance' in beat else 0
-    dissonance_cost = dissonance[harmony] * coeff
-    hnotes = notes[harmony]
-    vcost = sum(
-        100 if part in beat and get_voice(beat[part]) % 12 not in hnotes else 0
-        for part in 'satb'
-    )
+    cost = np.zeros(graph.size)
+    if 'dissonance' in beat:
+        cost += graph.dissonance * (-1. * beat['dissonance'])
+    for part in 'satb':
+        if part in beat:
+            cost += 100 * ((graph.pcs & NOTE_BITS[get_voice(beat[part])]) == 0)
+    if 'harmony' in beat:
+        cost[np.arange(graph.size) != graph.ids.get(beat['harmony'], -1)] = np.inf
+    return cost
+
+def reachable(data):
+    # Backward reachability over the transition graph. alive[idx] marks the
+    # harmony ids on beat idx from which every fixed 'harmony' later in data
+    # can still be met (alive[len(data)] is everything).
+    alive = [np.ones(graph.size, dtype=bool)]
+    for beat in data[::-1]:
+        mask = np.bincount(graph.sources, weights=alive[0][graph.indices], minlength=graph.size) > 0
+        if 'harmony' in beat:
+            mask &= np.arange(graph.size) == graph.ids.get(beat['harmony'], -1)
+        alive.insert(0, mask)
+    return alive
+
+def feasible(data, harmony):
+    # whether every fixed harmony in data can be met starting from harmony
+    if not any('harmony' in beat for beat in data[1:]):
+        return True
+    return reachable(data)[0][graph.ids[harmony]]
+
+def tonic(key):
+    # the key's tonic chord, as the graph names it ('I|C', 'i7|c')
+    candidates = [
+        harmony
+        for harmony in graph.harmonies
+        if harmony.split('|')[1] == key and harmony[0] in 'Ii' and harmony[1] not in 'iIvV'
+    ]
+    return min(candidates, key=len) if candidates else graph.harmonies[0]
+
+def substitute(harmony):
+    # a harmony of the graph to stand in for one it lacks: the simplest in
+    # the same key that extends its chord ('ii7|C' for 'ii|C'), or the tonic
+    chord, key = harmony.split('|')
+    candidates = [
+        other
+        for other in graph.harmonies
+        if other.split('|')[1] == key and other.startswith(chord)
+    ]
+    return min(candidates, key=len) if candidates else tonic(key)
+
+def known_harmonies(data):
+    # data for the search, without the fixed harmonies the graph doesn't
+    # know (which the user can enter, e.g. 'ii|C' in jazz). The search skips
+    # them, and starts from a substitute if data[0]'s is one.
+    unknown = [
+        idx
+        for idx, beat in enumerate(data)
+        if 'harmony' in beat and beat['harmony'] not in graph.ids
+    ]
+    if not unknown:
+        return data
+    data = list(data)
+    start = data[0].get('harmony')
+    for idx in unknown:
+        data[idx] = {key: value for key, value in data[idx].items() if key != 'harmony'}
+    if unknown[0] == 0:
+        data[0]['harmony'] = substitute(start)
+    return data
+
+def meetable_harmonies(data, harmony):
+    # data without the fixed harmonies that can't be met from harmony. Each
+    # is kept if it can still be met along with the ones kept before it.
+    kept = [data[0]] + [
+        {key: value for key, value in beat.items() if key != 'harmony'}
+        for beat in data[1:]
+    ]
+    for idx in range(1, len(data)):
+        if 'harmony' in data[idx]:
+            trial = kept[:idx] + [data[idx]] + kept[idx + 1:]
+            if reachable(trial)[0][graph.ids[harmony]]:
+                kept = trial
+    return kept
+
+def harmony_backward(data, start):
+    # log of the summed weight of all paths from (start, harmony id) to the
+    # end of data, up to a factor shared by every harmony.
+    #
+    # Every path that meets the fixed harmonies from start on goes through
+    # the first of them, so whatever comes after it scales all of them alike.
+    # The pass starts there instead of at the end, from the one state that
+    # can still meet the rest.
+    #
+    # The message at each beat only depends on the beats from there to end
+    # (and where the fixed harmonies after it are), so it is cached under
+    # that suffix, as a chain of nested tuples. When the window slides
+    # forward a beat, the part of the pass over beats it still shares is
+    # picked up from there.
+    fixed = [idx for idx in range(start, len(data)) if 'harmony' in data[idx]]
+    end = fixed[0] if fixed else len(data)
+    chain = [(len(data) - end,) + tuple((idx - end, data[idx]['harmony']) for idx in fixed)]
+    for idx in range(end - 1, start - 1, -1):
+        chain.append((_harmony_context(data[idx]), chain[-1]))
+
+    # chain[n] identifies the n beats before end
+    known = len(chain) - 1
+    backward = backward_cache.get((chain[known], known))
+    while backward is None and known > 0:
+        known -= 1
+        backward = backward_cache.get((chain[known], known))
+    if backward is None:
+        backward = np.where(reachable(data)[end], 0., -np.inf) if fixed else np.zeros(graph.size)
+        backward.flags.writeable = False
+        backward_cache.put((chain[0], 0), backward)
+    for n in range(known + 1, len(chain)):
+        backward = segment_logsumexp(
+            -graph.costs + backward[graph.indices], graph.indptr
+        ) - harmony_costs(data, end - n)
+        backward.flags.writeable = False
+        backward_cache.put((chain[n], n), backward)
+    return backward
+
+def enumerate_paths(data, harmony):
+    # Every path through the transition graph over the next len(data) beats
+    # is weighted by exp(-cost). Rather than listing the paths, sum their
+    # weights with a backward pass over (beat index, harmony id) states,
+    # which is linear in the lookahead. Returns (next harmony, cost) pairs
+    # whose softmax is the same distribution the full enumeration gives.
+    atime('enumerate_paths')
+    if not feasible(data, harmony):
+        # the fixed harmonies can't all be met from here; search as if the
+        # ones in the way weren't there rather than return nothing
+        btime('enumerate_paths')
+        return enumerate_paths(meetable_harmonies(data, harmony), harmony)
+    backward = harmony_backward(data, 1)
+
+    weights = collections.defaultdict(list)
+    for target, new_cost in zip(*graph.successors(graph.ids[harmony])):
+        weights[target].append(-new_cost + backward[target])
+    btime('enumerate_paths')
     return [
-        (
-            tail if idx == 0 else harmony,
-            new_cost + dissonance_cost + tail_cost + vcost
-        )
-        for transition, new_cost in transitions(harmony).items()
-        for tail, tail_cost in enumerate_paths(data, idx + 1, apply_transition(harmony, transition))
+        (graph.harmonies[target], -np.logaddexp.reduce(weights[target]))
+        for target in weights
     ]
 
 def softmax(x):
@@ -193,7 +274,7 @@ def voicing_parallel_intervals_cost(prev, this):
 
 def voicing_cost(prev, this, next, beat):
     atime('voicing_cost')
-    voice_notes = [get_voice(this[part]) % 12 for part in 'satb']
+    voice_pcs = pcs_of(get_voice(this[part]) for part in 'satb')
     cost = sum([
         voicing_line_cost(prev[i], this[i])
         for i in 'satb'
@@ -208,65 +289,465 @@ def voicing_cost(prev, this, next, beat):
         voicing_spacing_cost(this, beat),
         voicing_parallel_intervals_cost(prev, this),
     ] + [
-        3. if note not in voice_notes else 0
-        for note in notes[beat['harmony']]
+        3. * POPCOUNT[chord_pcs(beat['harmony']) & ~voice_pcs]
     ]) * 5
     btime('voicing_cost')
     return cost
 
+# voicing_line_cost only depends on the distance between the two notes
+line_costs = np.array([voicing_line_cost((0,), (diff,)) for diff in range(128)])
+
+def chord_pcs(harmony):
+    # from the style's notes for harmonies outside the graph, or its
+    # substitute's if the style has none for it
+    if harmony not in graph.ids:
+        return pcs_of(graph.notes(harmony)) or int(graph.pcs[graph.ids[substitute(harmony)]])
+    return int(graph.pcs[graph.ids[harmony]])
+
+def chord_ranges(harmony):
+    # the chord tones each part can sing
+    if harmony not in graph.ids:
+        chord = chord_pcs(harmony)
+        return [
+            graph.ranges[part][(chord >> (graph.ranges[part] % 12)) & 1 == 1]
+            for part in 'satb'
+        ]
+    return graph.chord_ranges[graph.ids[harmony]]
+
+def part_line_costs(prev, next, part, hrange):
+    # voicing_line_cost into and out of each candidate note for one part
+    cost = np.zeros(len(hrange))
+    if part in prev:
+        cost += line_costs[np.abs(get_last(prev[part]) - hrange)]
+    if part in next:
+        cost += line_costs[np.abs(hrange - get_first(next[part]))]
+    return cost
+
 def enumerate_notes(prev, next, harmony, beat):
+    # Scores every soprano/alto/tenor/bass combination at once on an
+    # S x A x T x B grid; each entry equals voicing_cost for that voicing.
+    # Returns the voicings as (s, a, t, b) rows along with their costs.
     atime('enumerate_notes')
-    hranges = {
-        part: [
-            note
-            for note in config._ranges[part]
-            if note % 12 in notes[harmony]
-        ]
-        for part in 'satb'
-    }
-    l = [
-        ({
-            's': (s,),
-            'a': (a,),
-            't': (t,),
-            'b': (b,),
-        }, voicing_cost(prev, {
-            's': (s,),
-            'a': (a,),
-            't': (t,),
-            'b': (b,),
-        }, next, beat))
-        for s in hranges['s']
-        for a in hranges['a']
-        for t in hranges['t']
-        for b in hranges['b']
+    hranges = chord_ranges(harmony)
+    shape = tuple(len(hrange) for hrange in hranges)
+    s, a, t, b = voices = [
+        hrange.reshape([-1 if i == j else 1 for j in range(4)])
+        for i, hrange in enumerate(hranges)
     ]
+    cost = np.zeros(shape)
+
+    # line
+    for i, (part, hrange) in enumerate(zip('satb', hranges)):
+        cost += part_line_costs(prev, next, part, hrange).reshape(voices[i].shape)
+
+    # spacing
+    coeff = -.5 * beat['spacing'] if 'spacing' in beat else 0
+    cost += 10 * (
+        (s - a > 12).astype(int) + (a - t > 12) + (a >= s) + (t >= a) + (b >= t)
+    )
+    cost += (s - a) * coeff
+    cost += (a - t) * coeff
+    cost += (t - b) * coeff
+
+    # parallel intervals
+    if all(part in prev for part in 'satb'):
+        motion = [voice - get_voice(prev[part]) for part, voice in zip('satb', voices)]
+        for i in range(4):
+            for j in range(4):
+                if i != j:
+                    interval = (voices[i] - voices[j]) % 12
+                    cost += 10 * (
+                        (motion[i] == motion[j]) & ((interval == 7) | (interval == 0))
+                    )
+
+    # chord coverage
+    covered = NOTE_BITS[s] | NOTE_BITS[a] | NOTE_BITS[t] | NOTE_BITS[b]
+    cost += 3. * POPCOUNT[chord_pcs(harmony) & ~covered]
+
+    cost *= 5
+    voicings = np.stack(np.meshgrid(*hranges, indexing='ij'), axis=-1).reshape(-1, 4)
     btime('enumerate_notes')
-    return l
+    return voicings, cost.reshape(-1)
+
+# Grids larger than this are searched with beam_notes instead of scored
+# exhaustively, keeping the VOICING_BEAM best partial voicings per part.
+VOICING_EXHAUSTIVE_LIMIT = 4096
+VOICING_BEAM = 256
+
+def beam_notes(prev, next, harmony, beat, width=VOICING_BEAM):
+    # Beam search over soprano -> alto -> tenor -> bass. Partial voicings are
+    # ranked by their exact cost so far plus a lower bound on the rest: the
+    # cheapest line cost of each remaining part, the best case of the
+    # spacing preference, and the chord tones too many to still be covered.
+    # Only the width best survive each step. Returns the surviving voicings
+    # and their full costs, like enumerate_notes.
+    atime('beam_notes')
+    hranges = chord_ranges(harmony)
+    lines = [part_line_costs(prev, next, part, hrange) for part, hrange in zip('satb', hranges)]
+    coeff = -.5 * beat['spacing'] if 'spacing' in beat else 0
+    prev_voices = [get_voice(prev[part]) for part in 'satb'] if all(part in prev for part in 'satb') else None
+    chord = chord_pcs(harmony)
+
+    # the spacing preference telescopes to (s - b) * coeff, so its best case
+    # from any voice x down is x * coeff minus the largest b * coeff
+    best_bass = np.max(hranges[3] * coeff)
+
+    voicings = np.zeros((1, 0), dtype=int)
+    covered = np.zeros(1, dtype=int)
+    cost = np.zeros(1)
+    for k in range(4):
+        num = len(voicings)
+        voicings = np.hstack([
+            np.repeat(voicings, len(hranges[k]), axis=0),
+            np.tile(hranges[k], num)[:, None],
+        ])
+        covered = np.repeat(covered, len(hranges[k])) | np.tile(NOTE_BITS[hranges[k]], num)
+        cost = np.repeat(cost, len(hranges[k])) + np.tile(lines[k], num)
+        x = voicings[:, k]
+
+        # spacing against the voice above
+        if k > 0:
+            y = voicings[:, k - 1]
+            cost += 10 * ((x >= y).astype(int) + ((y - x > 12) if k < 3 else 0))
+            cost += (y - x) * coeff
+
+        # parallel intervals against every voice above
+        if prev_voices is not None:
+            for j in range(k):
+                y = voicings[:, j]
+                same_motion = x - prev_voices[k] == y - prev_voices[j]
+                for interval in ((x - y) % 12, (y - x) % 12):
+                    cost += 10 * (same_motion & ((interval == 7) | (interval == 0)))
+
+        uncovered = POPCOUNT[chord & ~covered]
+        if k == 3:
+            cost += 3. * uncovered
+            bound = 0
+        else:
+            bound = (
+                sum(np.min(line) for line in lines[k + 1:])
+                + x * coeff - best_bass
+                + 3. * np.maximum(uncovered - (3 - k), 0)
+            )
+        if len(voicings) > width:
+            keep = np.argpartition(cost + bound, width)[:width]
+            voicings = voicings[keep]
+            covered = covered[keep]
+            cost = cost[keep]
+
+    btime('beam_notes')
+    return voicings, cost * 5
+
+# Joint search: instead of picking the next harmony first and voicing it
+# afterwards, search over (harmony, voicing) states for the first
+# JOINT_HORIZON beats of the window, so voice leading into the following
+# beats also weighs on which harmony comes next. Each harmony keeps only
+# its JOINT_VOICINGS best voicings, built from the JOINT_NOTES chord tones
+# per part closest to where that part last was. Beats past the horizon are
+# scored by harmony alone, as in enumerate_paths.
+joint_search = False
+JOINT_HORIZON = 4
+JOINT_NOTES = 4
+JOINT_VOICINGS = 8
+
+def joint_candidates(refs, fixed, coeff):
+    # Every harmony's pruned voicings, as an H x V x 4 array of notes, with
+    # their spacing and chord coverage cost (inf for padding). refs[part] is
+    # the note the part comes from (or None); fixed[part] is a note the part
+    # must sing.
+    notes = []
+    lines = []
+    for part in 'satb':
+        if part in fixed:
+            notes.append(np.full((graph.size, 1), fixed[part]))
+            lines.append(np.zeros((graph.size, 1)))
+            continue
+        table = graph.chord_range_table[part]
+        line = np.where(table >= 0, 0., np.inf)
+        if refs[part] is not None:
+            line += line_costs[np.abs(table - refs[part])]
+        order = np.argsort(line, axis=1, kind='mergesort')[:, :JOINT_NOTES]
+        notes.append(np.take_along_axis(table, order, axis=1))
+        lines.append(np.take_along_axis(line, order, axis=1))
+
+    # all combinations per harmony, on an H x S x A x T x B grid
+    s, a, t, b = voices = [
+        part_notes.reshape([graph.size] + [-1 if i == j else 1 for j in range(4)])
+        for i, part_notes in enumerate(notes)
+    ]
+    line = sum(
+        part_line.reshape(voice.shape)
+        for part_line, voice in zip(lines, voices)
+    )
+    cost = 10 * (
+        (s - a > 12).astype(int) + (a - t > 12) + (a >= s) + (t >= a) + (b >= t)
+    ) + (s - b) * coeff
+    covered = NOTE_BITS[s] | NOTE_BITS[a] | NOTE_BITS[t] | NOTE_BITS[b]
+    cost = cost + 3. * POPCOUNT[graph.pcs.reshape(-1, 1, 1, 1, 1) & ~covered]
+    rank = (cost + line).reshape(graph.size, -1)
+    cost = np.broadcast_to(5 * cost, line.shape).reshape(graph.size, -1)
+    voicings = np.stack(np.broadcast_arrays(s, a, t, b), axis=-1).reshape(graph.size, -1, 4)
+
+    if rank.shape[1] > JOINT_VOICINGS:
+        keep = np.argpartition(rank, JOINT_VOICINGS - 1, axis=1)[:, :JOINT_VOICINGS]
+        rank = np.take_along_axis(rank, keep, axis=1)
+        cost = np.take_along_axis(cost, keep, axis=1)
+        voicings = np.take_along_axis(voicings, keep[:, :, None], axis=1)
+    return voicings, np.where(np.isfinite(rank), cost, np.inf)
+
+# Voice leading from each voicing in prev to each in this, where the last
+# axis of both is (s, a, t, b) and the others broadcast.
+def joint_line_costs(prev, this):
+    return 5 * line_costs[np.abs(this - prev)].sum(axis=-1)
+
+def joint_parallel_costs(prev, this):
+    cost = 0
+    motion = this - prev
+    for i in range(4):
+        for j in range(4):
+            if i != j:
+                interval = (this[..., i] - this[..., j]) % 12
+                cost += 10 * (
+                    (motion[..., i] == motion[..., j]) & ((interval == 7) | (interval == 0))
+                )
+    return 5 * cost
+
+def enumerate_joint(data, harmony):
+    # Backward pass over (beat, harmony, voicing) states, like enumerate_paths
+    # over (beat, harmony). Returns the next beat's harmonies, voicings (as
+    # (s, a, t, b) rows) and costs; their softmax is the distribution over
+    # every path through the lattice.
+    atime('enumerate_joint')
+    if not feasible(data, harmony):
+        btime('enumerate_joint')
+        return enumerate_joint(meetable_harmonies(data, harmony), harmony)
+    horizon = min(JOINT_HORIZON, len(data) - 1)
+
+    # candidates for each beat, from the last known note of each part and
+    # the last known spacing. Beats with nothing new share them.
+    candidates = []
+    refs = {part: get_last(data[0][part]) if part in data[0] else None for part in 'satb'}
+    spacing = data[0].get('spacing')
+    for beat in data[1:horizon + 1]:
+        spacing = beat.get('spacing', spacing)
+        fixed = {part: get_voice(beat[part]) for part in 'satb' if part in beat}
+        key = (tuple(sorted(refs.items())), tuple(sorted(fixed.items())), spacing)
+        if candidates and candidates[-1][0] == key:
+            candidates.append(candidates[-1])
+        else:
+            coeff = -.5 * spacing if spacing is not None else 0
+            candidates.append((key,) + joint_candidates(refs, fixed, coeff))
+        refs.update({part: get_last(beat[part]) for part in fixed})
+
+    # log of the summed weight of all paths from (idx, harmony, voicing)
+    tail = segment_logsumexp(
+        -graph.costs + harmony_backward(data, horizon + 1)[graph.indices], graph.indptr
+    )
+    backward = (tail - harmony_costs(data, horizon))[:, None] - candidates[horizon - 1][2]
+    leading = {}
+    for idx in range(horizon - 1, 0, -1):
+        this, after = candidates[idx - 1], candidates[idx]
+        if (this[0], after[0]) not in leading:
+            prev = this[1][graph.sources][:, :, None, :]
+            voicings = after[1][graph.indices][:, None, :, :]
+            leading[this[0], after[0]] = (
+                graph.costs[:, None, None]
+                + joint_line_costs(prev, voicings)
+                + joint_parallel_costs(prev, voicings)
+            )
+        step = -leading[this[0], after[0]] + backward[graph.indices][:, None, :]
+        m = np.max(step, axis=2)
+        m[~np.isfinite(m)] = 0
+        with np.errstate(divide='ignore'):
+            step = m + np.log(np.exp(step - m[:, :, None]).sum(axis=2))
+        backward = segment_logsumexp(step, graph.indptr) - harmony_costs(data, idx)[:, None] - this[2]
+
+    # into the next beat from the notes actually sounding now
+    targets, costs = graph.successors(graph.ids[harmony])
+    order = np.argsort(targets, kind='mergesort')
+    targets, costs = targets[order], costs[order]
+    voicings = candidates[0][1][targets]
+    weight = -costs[:, None] + backward[targets]
+    for k, part in enumerate('satb'):
+        if part in data[0]:
+            weight -= 5 * line_costs[np.abs(voicings[:, :, k] - get_last(data[0][part]))]
+    if all(part in data[0] for part in 'satb'):
+        weight -= joint_parallel_costs(np.array([get_voice(data[0][part]) for part in 'satb']), voicings)
+
+    # a harmony reached by more than one transition collects all of them
+    starts = np.flatnonzero(np.r_[True, targets[1:] != targets[:-1]])
+    targets = targets[starts]
+    voicings = voicings[starts]
+    with np.errstate(invalid='ignore'):
+        weight = np.logaddexp.reduceat(weight, starts)
+    finite = np.isfinite(weight)
+    btime('enumerate_joint')
+    return (
+        [graph.harmonies[target] for target in np.repeat(targets, finite.sum(axis=1))],
+        voicings[finite],
+        -weight[finite],
+    )
 
-def decorate(base, chord, scale):
-    if np.random.randint(0,100) < 20:
+# Distributions already computed for a context. They hold probabilities
+# rather than sampled results, so a hit still gets a fresh random choice.
+HARMONY_CACHE_SIZE = 1024
+VOICING_CACHE_SIZE = 64
+JOINT_CACHE_SIZE = 256
+# backward messages of harmony_backward, by suffix
+BACKWARD_CACHE_SIZE = 1024
+backward_cache = LRUCache(BACKWARD_CACHE_SIZE)
+harmony_cache = LRUCache(HARMONY_CACHE_SIZE)
+voicing_cache = LRUCache(VOICING_CACHE_SIZE)
+joint_cache = LRUCache(JOINT_CACHE_SIZE)
+# by name, for reporting their hit rates
+caches = {
+    'harmony': harmony_cache,
+    'voicing': voicing_cache,
+    'joint': joint_cache,
+    'backward': backward_cache,
+}
+
+# (hits, misses) of each cache so far
+def cache_stats():
+    return {name: (cache.hits, cache.misses) for name, cache in caches.items()}
+
+# Takes the counts so far and zeroes them, like timing.collect. Worker
+# processes send these to the parent, which merges them into its own.
+def collect_cache_stats():
+    snapshot = cache_stats()
+    for cache in caches.values():
+        cache.hits = cache.misses = 0
+    return snapshot
+
+def merge_cache_stats(snapshot):
+    for name, (hits, misses) in snapshot.items():
+        caches[name].hits += hits
+        caches[name].misses += misses
+
+# the parts of a beat the path search looks at
+def _harmony_context(beat):
+    return (
+        beat.get('harmony'),
+        beat.get('dissonance'),
+        tuple(get_voice(beat[part]) % 12 if part in beat else None for part in 'satb'),
+    )
+
+def harmony_distribution(data, harmony):
+    # (next harmonies, probabilities) for the path search over data
+    key = (harmony,) + tuple(_harmony_context(beat) for beat in data[1:])
+    distribution = harmony_cache.get(key)
+    if distribution is None:
+        paths, costs = zip(*enumerate_paths(data, harmony))
+        distribution = paths, softmax(-np.array(costs))
+        harmony_cache.put(key, distribution)
+    return distribution
+
+def voicing_distribution(prev, next, harmony, beat):
+    # (voicings, probabilities) for enumerate_notes
+    key = (
+        harmony,
+        beat.get('spacing'),
+        tuple((get_last(prev[part]), get_voice(prev[part])) if part in prev else None for part in 'satb'),
+        tuple(get_first(next[part]) if part in next else None for part in 'satb'),
+    )
+    distribution = voicing_cache.get(key)
+    if distribution is None:
+        if np.prod([len(hrange) for hrange in chord_ranges(harmony)]) > VOICING_EXHAUSTIVE_LIMIT:
+            voicings, costs = beam_notes(prev, next, harmony, beat)
+        else:
+            voicings, costs = enumerate_notes(prev, next, harmony, beat)
+        distribution = voicings, softmax(-costs)
+        voicing_cache.put(key, distribution)
+    return distribution
+
+def joint_distribution(data, harmony):
+    # (next harmonies, voicings, probabilities) for enumerate_joint
+    horizon = min(JOINT_HORIZON, len(data) - 1)
+    key = (
+        harmony,
+        tuple((get_last(data[0][part]), get_voice(data[0][part])) if part in data[0] else None for part in 'satb'),
+        data[0].get('spacing'),
+    ) + tuple(
+        # enumerate_joint fixes each part to its voice and takes the next
+        # beat's reference note from its last note
+        _harmony_context(beat) + (beat.get('spacing'), tuple((get_voice(beat[part]), get_last(beat[part])) if part in beat else None for part in 'satb'))
+        for beat in data[1:horizon + 1]
+    ) + tuple(_harmony_context(beat) for beat in data[horizon + 1:])
+    distribution = joint_cache.get(key)
+    if distribution is None:
+        harmonies, voicings, costs = enumerate_joint(data, harmony)
+        distribution = harmonies, voicings, softmax(-costs)
+        joint_cache.put(key, distribution)
+    return distribution
+
+# Inputs the user is likely to enter for data[1], for precomputing their
+# autocomplete. Each is a dict to update data[1] with, setting exactly the
+# parts ('harmony' and / or 's') an input would: the count likeliest next
+# harmonies, the count likeliest soprano notes (under data[1]'s harmony, or
+# else the likeliest one), or with both, each of the count likeliest
+# harmonies with its likeliest soprano note. Harmonies the user entered that
+# the graph doesn't know give no guesses.
+def likely_inputs(data, parts, count):
+    if data[0]['harmony'] not in graph.ids:
+        return []
+    paths, probs = harmony_distribution(data, data[0]['harmony'])
+    order = np.argsort(-probs, kind='mergesort')
+    if 'harmony' in parts:
+        guesses = [{'harmony': paths[idx]} for idx in order[:count]]
+    else:
+        guesses = [{}]
+    if 's' not in parts:
+        return guesses
+
+    sopranos = count if len(guesses) == 1 else 1
+    inputs = []
+    for guess in guesses:
+        harmony = guess.get('harmony', data[1].get('harmony', paths[order[0]]))
+        if harmony not in graph.ids:
+            continue
+        voicings, probs = voicing_distribution(data[0], data[2], harmony, data[1])
+        weights = np.bincount(voicings[:, 0], weights=probs)
+        inputs += [
+            dict(guess, s=(int(note),))
+            for note in np.argsort(-weights, kind='mergesort')[:sopranos]
+            if weights[note] > 0
+        ]
+    return inputs
+
+# identifies an input (or guess) by everything in it but 'manual', frozen so
+# it can be looked up ('acc_rhythm' comes in as a dict)
+def input_key(beat):
+    return tuple(sorted((key, freeze(value)) for key, value in beat.items() if key != 'manual'))
+
+# chord and scale are pitch-class masks
+def decorate(base, chord, scale, rng=np.random):
+    if rng.randint(0,100) < 20:
         return [base]
     for i in range(100):
-        next_note = np.random.randint(base - 5, base + 6)
-        if next_note % 12 not in chord and not (abs(next_note - base) <= 2 and next_note % 12 in scale) or next_note not in config._ranges['s']:
+        next_note = rng.randint(base - 5, base + 6)
+        if not contains(chord, next_note) and not (abs(next_note - base) <= 2 and contains(scale, next_note)) or not in_notes(graph.range_masks['s'], next_note):
             continue
-        return [base] + decorate(next_note, chord, scale)
+        return [base] + decorate(next_note, chord, scale, rng)
     return [base]
 
-def autocomplete(data):
+# Returns a copy of data with data[1] filled in. horizon limits the harmony
+# search to the first horizon beats of data. The beats passed in are never
+# modified, so Beats and shared snapshots can be passed as they are.
+def autocomplete(data, horizon=None, rng=np.random):
     atime('autocomplete')
+    data = list(data)
+    data[1] = dict(data[1])
 
-    # retain rhythm
+    # retain rhythm (rhythms are never modified in place, so they are shared)
     if 'mel_rhythm' not in data[1]:
         if 'mel_rhythm' in data[0]:
-            data[1]['mel_rhythm'] = copy.deepcopy(data[0]['mel_rhythm'])
+            data[1]['mel_rhythm'] = data[0]['mel_rhythm']
         else:
             data[1]['mel_rhythm'] = (True,)
 
     if 'acc_rhythm' not in data[1]:
         if 'acc_rhythm' in data[0]:
-            data[1]['acc_rhythm'] = copy.deepcopy(data[0]['acc_rhythm'])
+            data[1]['acc_rhythm'] = data[0]['acc_rhythm']
         else:
             data[1]['acc_rhythm'] = {'a': (True,), 't': (True,), 'b': (True,)}
 
@@ -276,41 +757,61 @@ def autocomplete(data):
     if 'spacing' not in data[1] and 'spacing' in data[0]:
         data[1]['spacing'] = data[0]['spacing']
 
-    atime(1)
-    # find path in key/chord graph
-    paths, costs = zip(*enumerate_paths(data, 0, data[0]['harmony']))
-    np_costs = np.array(costs)
-    probs = softmax(-np_costs)
-    path_idx = np.random.choice(np.arange(len(paths)), p=probs)
-    path = paths[path_idx]
-    btime(1)
-
-    # set next key/chord
-    harmony = path
-    if 'harmony' not in data[1]:
+    # the search skips harmonies entered that the graph doesn't know
+    search = known_harmonies(data)
+
+    joint = None
+    if joint_search:
+        # pick key/chord and notes together
+        atime('joint')
+        harmonies, voicings, probs = joint_distribution(search[:horizon], search[0]['harmony'])
+        if len(harmonies):
+            joint = rng.choice(np.arange(len(harmonies)), p=probs)
+            harmony = harmonies[joint]
+            picked = voicings[joint]
+        btime('joint')
+
+    if joint is None:
+        atime('harmony')
+        # find path in key/chord graph
+        paths, probs = harmony_distribution(search[:horizon], search[0]['harmony'])
+        path_idx = rng.choice(np.arange(len(paths)), p=probs)
+        harmony = paths[path_idx]
+        btime('harmony')
+
+    # set next key/chord. A harmony entered is voiced as it is, even where
+    # the search had to go without it.
+    if 'harmony' in data[1]:
+        if harmony != data[1]['harmony']:
+            joint = None
+        harmony = data[1]['harmony']
+    else:
         data[1]['harmony'] = harmony
 
-    atime(2)
-    # pick notes based on key/chord
-    voicings, costs = zip(*enumerate_notes(data[0], data[2], harmony, data[1]))
-    np_costs = np.array(costs)
-    probs = softmax(-np_costs)
-    voicings_idx = np.random.choice(np.arange(len(voicings)), p=probs)
-    voicing = voicings[voicings_idx]
-    btime(2)
+    if joint is None:
+        atime('voicing')
+        # pick notes based on key/chord
+        voicings, probs = voicing_distribution(data[0], data[2], harmony, data[1])
+        voicings_idx = rng.choice(np.arange(len(voicings)), p=probs)
+        picked = voicings[voicings_idx]
+        btime('voicing')
+    voicing = {
+        part: (int(note),)
+        for part, note in zip('satb', picked)
+    }
 
     # set notes
-    data[1] = dict(voicing.items() + data[1].items())
+    voicing.update(data[1])
+    data[1] = voicing
 
     # decorations
-    atime(3)
-    decorated = tuple(decorate(get_first(data[1]['s']), notes[data[1]['harmony']], config._scale(data[1]['harmony'].split('|')[1])))
+    atime('decoration')
+    decorated = tuple(decorate(get_first(data[1]['s']), chord_pcs(data[1]['harmony']), graph.scales[data[1]['harmony'].split('|')[1]], rng))
     data[1]['s'] = decorated
-    btime(3)
+    btime('decoration')
 
     # apply rhythm to voices
-    atime(4)
-    print(data)
+    atime('rhythm')
     for part in 'atb':
         p_notes = data[1][part]
         data[1][part] = tuple(
@@ -322,14 +823,36 @@ def autocomplete(data):
         s_notes[idx % len(s_notes)] if value == True else -1 if value == -1 else None
         for idx,value in enumerate(data[1]['mel_rhythm'])
     )
-    btime(4)
+    btime('rhythm')
 
     btime('autocomplete')
 
-    #print("RUNTIME\n-------")
-    #for i, t in runtime.items():
-    #    print("{}: {}".format(i, t))
-    #print("-------")
-
     return data
 
+
+def autocomplete_anytime(data, deadline=None, playback=None, cancelled=lambda: False, seed=None, beat_index=0):
+    # Anytime version of autocomplete. Searches ever longer lookaheads (2, 4,
+    # 8, ... beats) and yields (data, complete) pairs, where complete says
+    # whether the whole window was searched. If the full search can't finish
+    # by deadline, yields the deepest result that did, then keeps deepening
+    # for as long as it expects to finish before playback. Stops early once
+    # cancelled() returns True. Every pass starts from the same beat_rng, so
+    # the complete result doesn't depend on how many passes fit in.
+    horizon = min(2, len(data))
+    elapsed = 0
+    result = None
+    for cutoff in (deadline, playback):
+        improved = False
+        while result is None or cutoff is None or time.time() + 2 * elapsed < cutoff:
+            if cancelled():
+                return
+            start = time.time()
+            result = autocomplete(data, horizon, beat_rng(seed, beat_index))
+            elapsed = time.time() - start
+            if horizon >= len(data):
+                yield result, True
+                return
+            horizon = min(2 * horizon, len(data))
+            improved = True
+        if improved:
+            yield result, False
@@ -0,0 +1,239 @@
+import cPickle as pickle
+import struct
+
+from cache import LRUCache
+
+# Immutable beats. A Beat is a read-only mapping with the same keys and
+# values as the beat dicts described in BeatManager, except that 'manual'
+# is a frozenset and 'acc_rhythm' is itself a Beat. Edits return a new Beat
+# that shares every unchanged value with the old one, so a window of beats
+# can be snapshot by copying a list of references instead of deep-copying
+# it.
+#
+#   beat = Beat({'s': (72,), 'harmony': 'I|C'})
+#   beat.merge({'s': (74,)})   -> new Beat, 'harmony' shared with beat
+#   decode(beat.encode())      -> equal Beat
+#
+# Beats pickle to their encoding: a presence bitmask, then each present key
+# as int8 notes / rhythm values, length-prefixed strings and doubles. A
+# typical beat takes 30-40 bytes instead of a few hundred for a pickled
+# dict, and the encoding is computed once per Beat.
+
+KEYS = ('s', 'a', 't', 'b', 'harmony', 'spacing', 'dissonance', 'manual', 'mel_rhythm', 'acc_rhythm')
+PARTS = 'satb'
+BITS = {key: 1 << idx for idx, key in enumerate(KEYS)}
+
+# set in place of the presence bitmask for beats with keys outside KEYS,
+# which are pickled whole
+PICKLED = 0xffff
+
+# int8 stand-in for a rest (None) in a note tuple. -1 (hold) and MIDI notes
+# are stored as is.
+REST = -2
+
+# Successive autocomplete windows share all but one beat, so workers see
+# the same encodings over and over and decode each only once.
+DECODE_CACHE_SIZE = 1024
+decode_cache = LRUCache(DECODE_CACHE_SIZE)
+
+HEADER = struct.Struct('<H')
+FLOAT = struct.Struct('<d')
+MANUAL = {
+    mask: frozenset(key for key in KEYS if mask & BITS[key])
+    for mask in range(1 << len(KEYS))
+}
+
+# Not a collections.Mapping subclass: isinstance checks against ABCs are
+# slow, and freeze() does one per value.
+class Beat(object):
+    def __init__(self, items=()):
+        super(Beat, self).__init__()
+        self._items = {
+            key: freeze(value)
+            for key, value in dict(items).items()
+        }
+        self._hash = None
+        self._encoded = None
+
+    # a Beat owning items, which must already be frozen
+    @classmethod
+    def _wrap(cls, items):
+        beat = cls.__new__(cls)
+        beat._items = items
+        beat._hash = None
+        beat._encoded = None
+        return beat
+
+    def __getitem__(self, key):
+        return self._items[key]
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        return self._items.get(key, default)
+
+    def keys(self):
+        return self._items.keys()
+
+    def items(self):
+        return self._items.items()
+
+    def values(self):
+        return self._items.values()
+
+    def iteritems(self):
+        return self._items.iteritems()
+
+    def __eq__(self, other):
+        if isinstance(other, Beat):
+            return self is other or self._items == other._items
+        if isinstance(other, dict):
+            return self._items == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(frozenset(self._items.items()))
+        return self._hash
+
+    def __repr__(self):
+        return 'Beat({!r})'.format(self._items)
+
+    def __reduce__(self):
+        return decode, (self.encode(),)
+
+    # a Beat with the items of changes (a mapping) and kwargs added
+    def merge(self, changes=(), **kwargs):
+        items = dict(self._items)
+        for key, value in dict(changes, **kwargs).items():
+            items[key] = freeze(value)
+        return Beat._wrap(items)
+
+    # a Beat with only the given keys
+    def select(self, keys):
+        return Beat._wrap({
+            key: value
+            for key, value in self._items.items()
+            if key in keys
+        })
+
+    def encode(self):
+        if self._encoded is None:
+            self._encoded = _encode(self._items)
+        return self._encoded
+
+
+EMPTY = Beat()
+
+# immutable counterparts of the mutable types beat values come in
+FROZEN = {set: frozenset, dict: Beat, list: tuple}
+
+def freeze(value):
+    convert = FROZEN.get(type(value))
+    return value if convert is None else convert(value)
+
+# shares beat if it is already a Beat
+def as_beat(beat):
+    return beat if isinstance(beat, Beat) else Beat(beat)
+
+def _pack_notes(notes):
+    return struct.pack('B{}b'.format(len(notes)), len(notes), *[REST if note is None else note for note in notes])
+
+def _pack_rhythm(rhythm):
+    return struct.pack('B{}b'.format(len(rhythm)), len(rhythm), *[-1 if value == -1 else 1 if value else 0 for value in rhythm])
+
+def _encode(items):
+    if any(key not in BITS for key in items) or any(key not in BITS for key in items.get('manual', ())) \
+            or any(part not in PARTS for part in items.get('acc_rhythm', ())):
+        return HEADER.pack(PICKLED) + pickle.dumps({
+            key: dict(value) if isinstance(value, Beat) else value
+            for key, value in items.items()
+        }, pickle.HIGHEST_PROTOCOL)
+    present = 0
+    chunks = []
+    for key in KEYS:
+        if key not in items:
+            continue
+        present |= BITS[key]
+        value = items[key]
+        if key in PARTS:
+            chunks.append(_pack_notes(value))
+        elif key == 'harmony':
+            chunks.append(struct.pack('B', len(value)) + str(value))
+        elif key in ('spacing', 'dissonance'):
+            chunks.append(FLOAT.pack(value))
+        elif key == 'manual':
+            chunks.append(HEADER.pack(sum(BITS[manual] for manual in value)))
+        elif key == 'mel_rhythm':
+            chunks.append(_pack_rhythm(value))
+        else:
+            parts = [part for part in PARTS if part in value]
+            chunks.append(struct.pack('B', sum(BITS[part] for part in parts)))
+            chunks += [_pack_rhythm(value[part]) for part in parts]
+    return HEADER.pack(present) + ''.join(chunks)
+
+def _unpack_values(data, offset):
+    count = ord(data[offset])
+    return struct.unpack_from('{}b'.format(count), data, offset + 1), offset + 1 + count
+
+def _unpack_notes(data, offset):
+    values, offset = _unpack_values(data, offset)
+    if REST in values:
+        values = tuple(None if value == REST else value for value in values)
+    return values, offset
+
+def _unpack_rhythm(data, offset):
+    values, offset = _unpack_values(data, offset)
+    return tuple(-1 if value == -1 else value == 1 for value in values), offset
+
+def decode(data):
+    beat = decode_cache.get(data)
+    if beat is None:
+        beat = _decode(data)
+        beat._encoded = data
+        decode_cache.put(data, beat)
+    return beat
+
+def _decode(data):
+    present, = HEADER.unpack_from(data)
+    if present == PICKLED:
+        return Beat(pickle.loads(data[2:]))
+    items = {}
+    offset = 2
+    for key in KEYS:
+        if not present & BITS[key]:
+            continue
+        if key in PARTS:
+            items[key], offset = _unpack_notes(data, offset)
+        elif key == 'harmony':
+            length = ord(data[offset])
+            items[key] = data[offset + 1:offset + 1 + length]
+            offset += 1 + length
+        elif key in ('spacing', 'dissonance'):
+            items[key], = FLOAT.unpack_from(data, offset)
+            offset += 8
+        elif key == 'manual':
+            items[key] = MANUAL[HEADER.unpack_from(data, offset)[0]]
+            offset += 2
+        elif key == 'mel_rhythm':
+            items[key], offset = _unpack_rhythm(data, offset)
+        else:
+            parts = ord(data[offset])
+            offset += 1
+            rhythm = {}
+            for part in PARTS:
+                if parts & BITS[part]:
+                    rhythm[part], offset = _unpack_rhythm(data, offset)
+            items[key] = Beat._wrap(rhythm)
+    return Beat._wrap(items)
@@ -0,0 +1,194 @@
+import argparse
+import json
+import resource
+import sys
+import time
+
+import numpy as np
+
+import autocomplete
+from compose import compose, DEFAULT_SEED_BEAT
+
+# Benchmarks the autocomplete engine on fixed, seeded contexts for each
+# style, timing every call to autocomplete, enumerate_paths, enumerate_notes,
+# enumerate_joint and decorate, and reports latency percentiles and peak
+# memory.
+#
+#   python bench.py --save baseline.json
+#   python bench.py --compare baseline.json
+#
+# With --compare, a stage whose p50 grew by more than --threshold over the
+# baseline is reported as a regression and the exit status is 1.
+
+STYLES = ['jazz', 'classical']
+CONTEXT_SEED = 1234
+WINDOW = 16
+WARMUP = 5
+# each stage is timed this many times over and the round with the lowest
+# p50 is kept, to ride out frequency scaling and noisy neighbours
+ROUNDS = 3
+
+MINOR_SEED_BEAT = {
+    'jazz': {'s': (76,), 'a': (72,), 't': (67,), 'b': (57,), 'harmony': 'i7|a'},
+    'classical': {'s': (76,), 'a': (72,), 't': (64,), 'b': (57,), 'harmony': 'i|a'},
+}
+
+def key_of(beat):
+    return beat['harmony'].split('|')[1]
+
+def empty_window(first):
+    return [dict(first)] + [{} for i in range(WINDOW - 1)]
+
+# Contexts are built from pieces composed with fixed seeds, so the fixed
+# harmonies in them are always reachable.
+#   empty       : only the first beat is known
+#   constrained : every harmony is fixed and every beat after the next one
+#                 is fully written out
+#   modulating  : a harmony in another key is fixed a few beats ahead
+#   minor       : only the first beat is known, in a minor key
+def contexts(style):
+    piece = compose([DEFAULT_SEED_BEAT], WINDOW, seed=CONTEXT_SEED)
+    constrained = [dict(beat) for beat in piece]
+    constrained[1] = {'harmony': piece[1]['harmony']}
+
+    modulating = None
+    seed = CONTEXT_SEED
+    while modulating is None:
+        piece = compose([DEFAULT_SEED_BEAT], 4 * WINDOW, seed=seed)
+        for start in range(len(piece) - WINDOW):
+            for target in range(start + 4, start + WINDOW):
+                if key_of(piece[target]) != key_of(piece[start]):
+                    modulating = empty_window(piece[start])
+                    modulating[target - start] = {'harmony': piece[target]['harmony']}
+                    break
+            if modulating is not None:
+                break
+        seed += 1
+
+    return [
+        ('empty', empty_window(DEFAULT_SEED_BEAT)),
+        ('constrained', constrained),
+        ('modulating', modulating),
+        ('minor', empty_window(MINOR_SEED_BEAT[style])),
+    ]
+
+def clear_caches():
+    autocomplete.harmony_cache.clear()
+    autocomplete.voicing_cache.clear()
+    autocomplete.joint_cache.clear()
+    autocomplete.backward_cache.clear()
+
+# seconds taken by each of iterations calls to fn, after WARMUP untimed ones
+def timed(fn, iterations, setup=lambda i: ()):
+    samples = []
+    for i in range(-WARMUP, iterations):
+        args = setup(i)
+        start = time.time()
+        fn(*args)
+        if i >= 0:
+            samples.append(time.time() - start)
+    return samples
+
+def stats(samples):
+    samples = 1e6 * np.array(samples)
+    return {
+        'mean_us': float(samples.mean()),
+        'p50_us': float(np.percentile(samples, 50)),
+        'p90_us': float(np.percentile(samples, 90)),
+        'p99_us': float(np.percentile(samples, 99)),
+        'max_us': float(samples.max()),
+    }
+
+def measure(fn, iterations, setup=lambda i: ()):
+    return min(
+        (stats(timed(fn, iterations, setup)) for i in range(ROUNDS)),
+        key=lambda row: row['p50_us']
+    )
+
+def peak_memory_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024. * 1024 if sys.platform == 'darwin' else 1024.)
+
+def bench_context(window, iterations):
+    # harmony and notes of the beat being filled, as one autocomplete picks them
+    clear_caches()
+    filled = autocomplete.autocomplete(window, rng=autocomplete.beat_rng(CONTEXT_SEED, 1))[1]
+    harmony = filled['harmony']
+    chord = autocomplete.chord_pcs(harmony)
+    scale = autocomplete.graph.scales[key_of(filled)]
+    base = autocomplete.get_first(filled['s'])
+
+    def fresh_window(i):
+        clear_caches()
+        return window, None, autocomplete.beat_rng(CONTEXT_SEED, i + WARMUP)
+
+    # the path searches reuse backward messages across calls
+    def cold(i):
+        clear_caches()
+        return ()
+
+    return {
+        'autocomplete': measure(autocomplete.autocomplete, iterations, fresh_window),
+        'enumerate_paths': measure(lambda: autocomplete.enumerate_paths(window, window[0]['harmony']), iterations, cold),
+        'enumerate_notes': measure(lambda: autocomplete.enumerate_notes(window[0], window[2], harmony, window[1]), iterations),
+        'enumerate_joint': measure(lambda: autocomplete.enumerate_joint(window, window[0]['harmony']), iterations, cold),
+        'decorate': measure(lambda rng: autocomplete.decorate(base, chord, scale, rng), iterations,
+                            lambda i: (autocomplete.beat_rng(CONTEXT_SEED, i + WARMUP),)),
+    }
+
+def run(styles, iterations):
+    results = {}
+    for style in styles:
+        autocomplete.autocomplete_config(style)
+        for name, window in contexts(style):
+            results['{}/{}'.format(style, name)] = bench_context(window, iterations)
+    return {'iterations': iterations, 'peak_memory_mb': peak_memory_mb(), 'results': results}
+
+def report(run):
+    print '{:<24} {:<16} {:>10} {:>10} {:>10} {:>10}'.format('context', 'stage', 'p50 us', 'p90 us', 'p99 us', 'max us')
+    for context in sorted(run['results']):
+        for stage, row in sorted(run['results'][context].items()):
+            print '{:<24} {:<16} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+                context, stage, row['p50_us'], row['p90_us'], row['p99_us'], row['max_us'])
+    print 'peak memory {:.1f} MB'.format(run['peak_memory_mb'])
+
+# returns the (context, stage, ratio) of every stage whose p50 is more than
+# threshold times its baseline
+def compare(run, baseline, threshold):
+    regressions = []
+    print '{:<24} {:<16} {:>12} {:>12} {:>8}'.format('context', 'stage', 'base p50', 'p50', 'ratio')
+    for context in sorted(run['results']):
+        for stage, row in sorted(run['results'][context].items()):
+            base = baseline['results'].get(context, {}).get(stage)
+            if base is None:
+                continue
+            ratio = row['p50_us'] / base['p50_us']
+            flag = ' REGRESSED' if ratio > threshold else ''
+            print '{:<24} {:<16} {:>12.1f} {:>12.1f} {:>7.2f}x{}'.format(
+                context, stage, base['p50_us'], row['p50_us'], ratio, flag)
+            if ratio > threshold:
+                regressions.append((context, stage, ratio))
+    print 'peak memory {:.1f} MB (baseline {:.1f} MB)'.format(run['peak_memory_mb'], baseline['peak_memory_mb'])
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the autocomplete engine.')
+    parser.add_argument('styles', nargs='*', default=STYLES, help='style modules to benchmark')
+    parser.add_argument('--iterations', type=int, default=50, help='timed calls per stage and context')
+    parser.add_argument('--save', metavar='FILE', help='write the results to FILE as a baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results against a saved baseline')
+    parser.add_argument('--threshold', type=float, default=1.25, help='p50 ratio over the baseline that counts as a regression')
+    args = parser.parse_args()
+
+    results = run(args.styles, args.iterations)
+    report(results)
+    if args.save:
+        json.dump(results, open(args.save, 'w'), indent=2, sort_keys=True)
+    if args.compare:
+        print
+        if compare(results, json.load(open(args.compare, 'r')), args.threshold):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import argparse
+import random
+import time
+
+from common.clock import Clock, Scheduler, AudioScheduler, SimpleTempoMap, kTicksPerQuarter
+
+# Benchmarks the schedulers in common/clock.py with dense command streams:
+# posting commands one at a time and with post_many, removing a share of
+# them, and running them all.
+#
+#   python bench_sched.py --commands 100000
+
+SEED = 1234
+# spread of the posted ticks, in beats
+SPAN = 2000
+# fast enough that the AudioScheduler covers SPAN beats in a few seconds
+# of audio
+TEMPO = 60000
+BUFFER_SIZE = 512
+
+def noop(tick, arg):
+    pass
+
+def random_ticks(count):
+    rng = random.Random(SEED)
+    return [rng.randrange(SPAN * kTicksPerQuarter) for i in range(count)]
+
+def timed(fn):
+    start = time.time()
+    result = fn()
+    return time.time() - start, result
+
+def run_scheduler(sched, drain, ticks, remove_share):
+    rows = []
+    elapsed, cmds = timed(lambda: [sched.post_at_tick(tick, noop) for tick in ticks])
+    rows.append(('post_at_tick', len(ticks), elapsed))
+
+    removed = random.Random(SEED).sample(cmds, int(len(cmds) * remove_share))
+    elapsed, _ = timed(lambda: [sched.remove(cmd) for cmd in removed])
+    rows.append(('remove', len(removed), elapsed))
+
+    elapsed, _ = timed(lambda: sched.post_many([(tick, noop, None) for tick in ticks]))
+    rows.append(('post_many', len(ticks), elapsed))
+
+    elapsed, _ = timed(drain)
+    rows.append(('run', 2 * len(ticks) - len(removed), elapsed))
+    return rows
+
+def bench_scheduler(ticks, remove_share):
+    clock = Clock()
+    clock.stop()
+    clock.set_time(0)
+    tempo_map = SimpleTempoMap(TEMPO)
+    sched = Scheduler(clock, tempo_map)
+
+    def drain():
+        clock.set_time(tempo_map.tick_to_time(SPAN * kTicksPerQuarter))
+        sched.on_update()
+
+    return run_scheduler(sched, drain, ticks, remove_share)
+
+def bench_audio_scheduler(ticks, remove_share):
+    tempo_map = SimpleTempoMap(TEMPO)
+    sched = AudioScheduler(tempo_map)
+
+    def drain():
+        while sched.get_tick() <= SPAN * kTicksPerQuarter:
+            sched.generate(BUFFER_SIZE, 2)
+
+    return run_scheduler(sched, drain, ticks, remove_share)
+
+def report(name, rows):
+    for stage, count, elapsed in rows:
+        print '{:<16} {:<14} {:>8} {:>10.1f} {:>10.2f}'.format(
+            name, stage, count, elapsed * 1e3, elapsed * 1e6 / max(count, 1))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Scheduler and AudioScheduler.')
+    parser.add_argument('--commands', type=int, default=100000, help='commands posted one at a time, and again with post_many')
+    parser.add_argument('--remove', type=float, default=.1, help='share of the first batch of commands to remove')
+    args = parser.parse_args()
+
+    ticks = random_ticks(args.commands)
+    print '{:<16} {:<14} {:>8} {:>10} {:>10}'.format('scheduler', 'stage', 'count', 'total ms', 'us each')
+    report('Scheduler', bench_scheduler(ticks, args.remove))
+    report('AudioScheduler', bench_audio_scheduler(ticks, args.remove))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+import collections
+
+# Bounded least-recently-used cache. get() returns None on a miss.
+class LRUCache(object):
+    def __init__(self, size):
+        super(LRUCache, self).__init__()
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        if key in self.entries:
+            del self.entries[key]
+        elif len(self.entries) >= self.size:
+            self.entries.popitem(last=False)
+        self.entries[key] = value
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
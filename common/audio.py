@@ -19,15 +19,28 @@ class Audio(object):
     # global variable: might change when Audio driver is set up.
     sample_rate = 44100
 
-    def __init__(self, num_channels, listen_func = None, input_func = None):
+    # With callback = True, PyAudio asks for each buffer from its own thread
+    # when the device needs it, and on_update() does nothing. control_func,
+    # if given, is called at the start of every buffer (before the generator
+    # runs), so control events can be applied on the audio thread within one
+    # buffer of when they arrive.
+    def __init__(self, num_channels, listen_func = None, input_func = None, callback = False, control_func = None):
         super(Audio, self).__init__()
 
         assert(num_channels == 1 or num_channels == 2)
         self.num_channels = num_channels
         self.listen_func = listen_func
         self.input_func = input_func
+        self.callback = callback
+        self.control_func = control_func
         self.audio = pyaudio.PyAudio()
 
+        # set before the stream opens: in callback mode it can start asking
+        # for audio right away
+        self.generator = None
+        self.cpu_time = 0
+        self.buffer = None
+
         out_dev, in_dev, buffer_size, sr = self._get_parameters()
         Audio.sample_rate = sr
 
@@ -39,10 +52,9 @@ class Audio(object):
                                       output = True,
                                       input = input_func != None,
                                       output_device_index = out_dev,
-                                      input_device_index = in_dev)
+                                      input_device_index = in_dev,
+                                      stream_callback = self._callback if callback else None)
 
-        self.generator = None
-        self.cpu_time = 0
         core.register_terminate_func(self.close)
 
     def close(self) :
@@ -53,6 +65,7 @@ class Audio(object):
     # set a generator. The generator must support the method
     # generate(num_frames, num_channels), 
     # which returns a numpy array of length (num_frames * num_channels)
+    # and may also support generate_into() (see below)
     def set_generator(self, gen) :
         self.generator = gen
 
@@ -60,8 +73,11 @@ class Audio(object):
     def get_cpu_load(self) :
         return 1000 * self.cpu_time
 
-    # must call this every frame.
+    # must call this every frame (unless in callback mode).
     def on_update(self):
+        if self.callback:
+            return
+
         t_start = time.time()
 
         # get input audio if desired
@@ -78,25 +94,54 @@ class Audio(object):
         # Ask the generator to generate some audio samples.
         num_frames = self.stream.get_write_available() # number of frames to supply
         if self.generator and num_frames != 0:
-            (data, continue_flag) = self.generator.generate(num_frames, self.num_channels)
+            self.stream.write(self._render(num_frames).tostring())
+
+        self._update_cpu_time(t_start)
+
+    # PyAudio's stream callback, called from the audio thread in callback
+    # mode whenever the device needs frame_count more frames.
+    def _callback(self, in_data, frame_count, time_info, status):
+        t_start = time.time()
 
-            # make sure we got the correct number of frames that we requested
-            assert len(data) == num_frames * self.num_channels, \
-                "asked for (%d * %d) frames but got %d" % (num_frames, self.num_channels, len(data))
+        if self.input_func and in_data:
+            self.input_func(np.fromstring(in_data, dtype=np.float32), self.num_channels)
 
-            # convert type if needed and write to stream
-            if data.dtype != np.float32:
-                data = data.astype(np.float32)
-            self.stream.write(data.tostring())
+        if self.control_func:
+            self.control_func()
 
-            # send data to listerner as well
-            if self.listen_func:
-                self.listen_func(data, self.num_channels)
+        # the device always needs a full buffer, silent if nothing plays
+        if self.generator:
+            data = self._render(frame_count)
+        else:
+            data = self._buffer(frame_count)
+            data.fill(0)
 
-            # continue flag
-            if not continue_flag:
-                self.generator = None
+        self._update_cpu_time(t_start)
+        return data.tostring(), pyaudio.paContinue
 
+    # num_frames of audio from the generator, in self.buffer. The buffer is
+    # reused for the next call, so listen_func must copy what it keeps.
+    def _render(self, num_frames):
+        data = self._buffer(num_frames)
+        continue_flag = generate_into(self.generator, data, num_frames, self.num_channels)
+
+        # send data to listerner as well
+        if self.listen_func:
+            self.listen_func(data, self.num_channels)
+
+        # continue flag
+        if not continue_flag:
+            self.generator = None
+
+        return data
+
+    # a view of self.buffer for num_frames, only reallocated when the
+    # device asks for more frames than ever before
+    def _buffer(self, num_frames):
+        self.buffer = grow_buffer(self.buffer, num_frames * self.num_channels)
+        return self.buffer[:num_frames * self.num_channels]
+
+    def _update_cpu_time(self, t_start):
         # how long this all took
         dt = time.time() - t_start
         a = 0.9
@@ -130,6 +175,34 @@ class Audio(object):
         return out_dev, in_dev, buf_size, sample_rate
 
 
+# Generators may support
+#   generate_into(out, num_frames, num_channels)
+# as well as generate(). It writes (num_frames * num_channels) samples into
+# out, a float32 numpy array allocated by the caller (often a view of a
+# bigger buffer), and returns the continue flag. Callers reuse their
+# buffers from one call to the next, so nothing is allocated per buffer.
+#
+# generate_into() calls gen.generate_into() if gen has it. Otherwise it
+# copies gen.generate()'s output into out, zero-padding it if it is short.
+def generate_into(gen, out, num_frames, num_channels):
+    if hasattr(gen, 'generate_into'):
+        return gen.generate_into(out, num_frames, num_channels)
+
+    (data, continue_flag) = gen.generate(num_frames, num_channels)
+    assert len(data) <= len(out), \
+        "asked for (%d * %d) frames but got %d" % (num_frames, num_channels, len(data))
+    out[:len(data)] = data
+    out[len(data):] = 0
+    return continue_flag
+
+# buf if it holds at least size samples, otherwise a new float32 buffer that
+# does
+def grow_buffer(buf, size):
+    if buf is None or len(buf) < size:
+        buf = np.empty(size, dtype=np.float32)
+    return buf
+
+
 # location of config file (in User's home directory)
 CONFIG_FILE = os.path.expanduser('~/audio_config.cfg')
 
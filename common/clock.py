@@ -9,8 +9,11 @@
 #####################################################################
 
 import time
+import heapq
+import itertools
+import gc
 import numpy as np
-from audio import Audio
+from audio import Audio, generate_into
 
 
 # Simple time keeper object. It starts at 0 and knows how to pause
@@ -131,12 +134,79 @@ class TempoMap(object):
         return data
 
 
-class Scheduler(object):
+# Pending commands of a scheduler, as a heap of (tick, sequence number,
+# command). Posting is O(log n), and commands with equal ticks run in the
+# order they were posted. remove() only marks a command as cancelled; it is
+# skipped when it reaches the top of the heap, and the heap is rebuilt
+# without cancelled commands once they make up half of it.
+class CommandQueue(object):
+    def __init__(self):
+        super(CommandQueue, self).__init__()
+        self.commands = []
+        self.sequence = itertools.count()
+        self.num_cancelled = 0
+
+    # add a record for the function to call at the particular tick
+    def post_at_tick(self, tick, func, arg = None) :
+        cmd = Command(tick, func, arg)
+        heapq.heappush(self.commands, (cmd.tick, next(self.sequence), cmd))
+        return cmd
+
+    # post many commands at once, given as (tick, func, arg) tuples.
+    # Returns the commands, in the same order.
+    def post_many(self, items) :
+        # the batch allocates no cycles, so the collector is held off while
+        # it is built instead of rescanning the queue every few hundred
+        # commands
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            entries = []
+            for tick, func, arg in items:
+                cmd = Command(tick, func, arg)
+                entries.append((cmd.tick, next(self.sequence), cmd))
+        finally:
+            if enabled:
+                gc.enable()
+        # pushing is cheap for random ticks; rebuilding only pays off once
+        # the batch outweighs what is already queued
+        if len(entries) > 2 * len(self.commands):
+            self.commands.extend(entries)
+            heapq.heapify(self.commands)
+        else:
+            for entry in entries:
+                heapq.heappush(self.commands, entry)
+        return [entry[2] for entry in entries]
+
+    # attempt a removal. Does nothing if cmd has already run or been removed
+    def remove(self, cmd):
+        if cmd is None or cmd.did_it or cmd.cancelled:
+            return
+        cmd.cancelled = True
+        self.num_cancelled += 1
+        if 2 * self.num_cancelled > len(self.commands):
+            self.commands = [entry for entry in self.commands if not entry[2].cancelled]
+            heapq.heapify(self.commands)
+            self.num_cancelled = 0
+
+    # the next command to run, or None if there are none left
+    def _peek(self):
+        while self.commands and self.commands[0][2].cancelled:
+            heapq.heappop(self.commands)
+            self.num_cancelled -= 1
+        if self.commands:
+            return self.commands[0][2]
+        return None
+
+    def _pop(self):
+        return heapq.heappop(self.commands)[2]
+
+
+class Scheduler(CommandQueue):
     def __init__(self, clock, tempo_map) :
         super(Scheduler, self).__init__()
         self.clock = clock
         self.tempo_map = tempo_map
-        self.commands = []
 
     def get_time(self) :
         return self.clock.get_time()
@@ -145,33 +215,15 @@ class Scheduler(object):
         sec = self.get_time()
         return self.tempo_map.time_to_tick(sec)
 
-    # add a record for the function to call at the particular tick
-    # keep the list of commands sorted from lowest to hightest tick
-    # make sure tick is the first argument so sorting will work out
-    # properly
-    def post_at_tick(self, tick, func, arg = None) :
-        now_tick = self.get_tick()
-
-        cmd = Command(tick, func, arg)
-        self.commands.append(cmd)
-        self.commands.sort(key = lambda x: x.tick)
-        return cmd
-
-    # attempt a removal. Does nothing if cmd is not found
-    def remove(self, cmd):
-        if cmd in self.commands:
-            idx = self.commands.index(cmd)
-            del self.commands[idx]
-
     # on_update should be called as often as possible.
     # the only trick here is to make sure we remove the command BEFORE
     # calling the command's function so we handle re-entry properly.
     def on_update(self):
         now_tick = self.get_tick()
-        while self.commands:
-            if self.commands[0].tick <= now_tick:
-                command = self.commands.pop(0)
-                command.execute()
+        while True:
+            command = self._peek()
+            if command is not None and command.tick <= now_tick:
+                self._pop().execute()
             else:
                 break
 
@@ -186,11 +238,10 @@ class Scheduler(object):
 # AudioScheduler is a Scheduler and Clock built into one class.
 # It is ALSO a Generator. For it to work, it must be inserted into
 # and Audio generator chain.
-class AudioScheduler(object):
+class AudioScheduler(CommandQueue):
     def __init__(self, tempo_map) :
         super(AudioScheduler, self).__init__()
         self.tempo_map = tempo_map
-        self.commands = []
 
         self.generator = None
         self.cur_frame = 0
@@ -200,40 +251,47 @@ class AudioScheduler(object):
 
     def generate(self, num_frames, num_channels) :
         output = np.empty(num_channels * num_frames, dtype = np.float32)
+        continue_flag = self.generate_into(output, num_frames, num_channels)
+        return output, continue_flag
+
+    def generate_into(self, output, num_frames, num_channels) :
         o_idx = 0
 
         # the current period of time goes from self.cur_frame to end_frame
         end_frame = self.cur_frame + num_frames
 
         # advance time and fire off commands for this time frame
-        while self.commands:
+        while True:
+            command = self._peek()
+            if command is None:
+                break
+
             # find the exact frame at which the next command should happen
-            cmd_tick = self.commands[0].tick
+            cmd_tick = command.tick
             cmd_time = self.tempo_map.tick_to_time(cmd_tick)
             cmd_frame = int(cmd_time * Audio.sample_rate)
 
             if cmd_frame < end_frame:
                 o_idx = self._generate_until(cmd_frame, num_channels, output, o_idx)
-                command = self.commands.pop(0)
-                command.execute()
+                self._pop().execute()
             else:
                 break
 
         self._generate_until(end_frame, num_channels, output, o_idx)
 
-        return output, True
+        return True
 
     # generate audio from self.cur_frame to to_frame
     def _generate_until(self, to_frame, num_channels, output, o_idx) :
         num_frames = to_frame - self.cur_frame
         if num_frames > 0:
+            # the generator writes straight into its part of output
+            next_o_idx = o_idx+(num_channels * num_frames)
             if self.generator:
-                data, cont = self.generator.generate(num_frames, num_channels)
+                generate_into(self.generator, output[o_idx : next_o_idx], num_frames, num_channels)
             else:
-                data = np.zeros(num_channels * num_frames, dtype=np.float32)
+                output[o_idx : next_o_idx] = 0
 
-            next_o_idx = o_idx+(num_channels * num_frames)
-            output[o_idx : next_o_idx] = data
             self.cur_frame += num_frames
             return next_o_idx
         else:
@@ -246,23 +304,6 @@ class AudioScheduler(object):
     def get_tick(self) :
         return self.tempo_map.time_to_tick(self.get_time())
 
-    # add a record for the function to call at the particular tick
-    def post_at_tick(self, tick, func, arg = None) :
-        now_time  = self.get_time()
-        post_time = self.tempo_map.tick_to_time(tick)
-
-        # create a command to hold the function/arg and sort by tick
-        cmd = Command(tick, func, arg)
-        self.commands.append(cmd)
-        self.commands.sort(key = lambda x: x.tick)
-        return cmd
-
-    # attempt a removal. Does nothing if cmd is not found
-    def remove(self, cmd):
-        if cmd in self.commands:
-            idx = self.commands.index(cmd)
-            del self.commands[idx]
-
     def now_str(self):
         time = self.get_time()
         tick = self.tempo_map.time_to_tick(time)
@@ -278,6 +319,7 @@ class Command(object):
         self.func = func
         self.arg = arg
         self.did_it = False
+        self.cancelled = False
 
     def execute(self):
         # ensure that execute only gets called once.
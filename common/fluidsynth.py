@@ -164,6 +164,16 @@ fluid_synth_write_s16 = cfunc('fluid_synth_write_s16', c_void_p,
                               ('roff', c_int, 1),
                               ('rincr', c_int, 1))
 
+fluid_synth_write_float = cfunc('fluid_synth_write_float', c_int,
+                                ('synth', c_void_p, 1),
+                                ('len', c_int, 1),
+                                ('lout', c_void_p, 1),
+                                ('loff', c_int, 1),
+                                ('lincr', c_int, 1),
+                                ('rout', c_void_p, 1),
+                                ('roff', c_int, 1),
+                                ('rincr', c_int, 1))
+
 fluid_synth_get_rev_roomsize = cfunc('fluid_synth_get_reverb_roomsize', c_double,
                                     ('synth', c_void_p, 1))
 
@@ -338,6 +348,17 @@ class Synth(object):
         """
         return fluid_synth_write_s16_stereo(self.synth, len)
 
+    def get_samples_into(self, out, len):
+        """Generate audio samples into out
+
+        out must be a contiguous float32 NumPy array of at least 2 * len
+        samples. It is filled with len frames of interleaved stereo
+        audio, on the scale of get_samples() / 32768, without allocating
+        a new array.
+
+        """
+        return fluid_synth_write_float(self.synth, len, out.ctypes.data, 0, 2, out.ctypes.data, 1, 2)
+
     def get_reverb_params(self) :
         """Return the 4 reverb parameters: (roomsize, damping, width, level)"""
         return (fluid_synth_get_rev_roomsize(self.synth),
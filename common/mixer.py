@@ -9,6 +9,7 @@
 #####################################################################
 
 import numpy as np
+from audio import generate_into, grow_buffer
 
 
 class Mixer(object):
@@ -16,6 +17,7 @@ class Mixer(object):
         super(Mixer, self).__init__()
         self.generators = []
         self.gain = 0.25;
+        self.buffer = None
 
     def add(self, gen) :
         if gen not in self.generators:
@@ -34,17 +36,27 @@ class Mixer(object):
         return len(self.generators)
 
     def generate(self, num_frames, num_channels) :
-        output = np.zeros(num_frames * num_channels)
+        output = np.empty(num_frames * num_channels, dtype = np.float32)
+        continue_flag = self.generate_into(output, num_frames, num_channels)
+        return (output, continue_flag)
+
+    def generate_into(self, out, num_frames, num_channels) :
+        out.fill(0)
+
+        # each generator writes into self.buffer, which is then added to out.
+        # generate_into() falls back to generate() for generators without
+        # generate_into(). generate() must return (signal, keep_going). If
+        # keep_going is True, it means the generator has more to generate.
+        # False means generator is done and will be removed from the list.
+        # signal must be a numpay array of length num_frames * num_channels
+        # (or less)
+        self.buffer = grow_buffer(self.buffer, len(out))
+        signal = self.buffer[:len(out)]
 
-        # this calls generate() for each generator. generator must return:
-        # (signal, keep_going). If keep_going is True, it means the generator
-        # has more to generate. False means generator is done and will be
-        # removed from the list. signal must be a numpay array of length
-        # num_frames * num_channels (or less)
         kill_list = []
         for g in self.generators:
-            (signal, keep_going) = g.generate(num_frames, num_channels)
-            output += signal
+            keep_going = generate_into(g, signal, num_frames, num_channels)
+            out += signal
             if not keep_going:
                 kill_list.append(g)
 
@@ -52,5 +64,5 @@ class Mixer(object):
         for g in kill_list:
             self.generators.remove(g)
 
-        output *= self.gain
-        return (output, True)
+        out *= self.gain
+        return True
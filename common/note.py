@@ -36,6 +36,11 @@ class NoteGenerator(object):
         self.harmonics = harmonics
 
     def generate(self, num_frames, num_channels) :
+        output = np.empty(num_frames * num_channels, dtype = np.float32)
+        continue_flag = self.generate_into(output, num_frames, num_channels)
+        return (output, continue_flag)
+
+    def generate_into(self, out, num_frames, num_channels) :
         # normal case:
         end_frame = self.frame + num_frames
         continue_flag = True
@@ -49,18 +54,17 @@ class NoteGenerator(object):
         env = self.env.generate(num_frames)                # envelope
 
         # final output with gain and envelope
-        output = self.gain * env * sin_with_harmonics( factor * frames,  self.harmonics)
+        output = sin_with_harmonics( factor * frames,  self.harmonics)
+        output *= env
+        output *= self.gain
 
         self.frame += num_frames
 
-        # convert from mono to stereo
-        if num_channels == 2:
-            stereo = np.empty(num_frames * 2)
-            stereo[0::2] = output
-            stereo[1::2] = output
-            output = stereo
+        # write the same signal to every channel (mono to stereo)
+        for n in range(num_channels):
+            out[n::num_channels] = output
 
-        return (output, continue_flag)
+        return continue_flag
 
 
 def sin_with_harmonics(time, harmonics) :
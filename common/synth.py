@@ -32,3 +32,10 @@ class Synth(fluidsynth.Synth, object):
         samples = self.get_samples(num_frames).astype(np.float32)
         samples *= (1.0/32768.0)
         return (samples, True)
+
+    def generate_into(self, out, num_frames, num_channels):
+        assert(num_channels == 2)
+        # fluidsynth renders float samples straight into out, on the same
+        # scale as generate() (but not clipped to [-1, 1])
+        self.get_samples_into(out, num_frames)
+        return True
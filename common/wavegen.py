@@ -10,6 +10,7 @@
 
 
 import numpy as np
+from audio import generate_into, grow_buffer
 
 # generates audio data by asking an audio-source (ie, WaveFile) for that data.
 class WaveGenerator(object):
@@ -45,17 +46,23 @@ class WaveGenerator(object):
         return self.gain
 
     def generate(self, num_frames, num_channels) :
+        output = np.empty(num_frames * num_channels, dtype = np.float32)
+        continue_flag = self.generate_into(output, num_frames, num_channels)
+        return (output, continue_flag)
+
+    def generate_into(self, out, num_frames, num_channels) :
         if self.paused:
-            output = np.zeros(num_frames * num_channels)
-            return (output, True)
+            out.fill(0)
+            return True
 
         else:
             # get data based on our position and requested # of frames
-            output = self.source.get_frames(self.frame, self.frame + num_frames)
-            output *= self.gain
+            data = self.source.get_frames(self.frame, self.frame + num_frames)
+            filled = len(data)
+            out[:filled] = data
 
             # check for end-of-buffer condition:
-            actual_num_frames = len(output) / num_channels
+            actual_num_frames = filled / num_channels
             continue_flag = actual_num_frames == num_frames
 
             # advance current-frame
@@ -66,19 +73,22 @@ class WaveGenerator(object):
             if self.loop and not continue_flag:
                 continue_flag = True
                 remainder = num_frames - actual_num_frames
-                output = np.append(output, self.source.get_frames(0, remainder))
+                data = self.source.get_frames(0, remainder)
+                out[filled : filled + len(data)] = data
+                filled += len(data)
                 self.frame = remainder
 
             if self._release:
                 continue_flag = False
 
-            # zero-pad if output is too short (may happen if not looping / end of buffer)
-            shortfall = num_frames * num_channels - len(output)
-            if shortfall > 0:
-                output = np.append(output, np.zeros(shortfall))
+            # apply gain (in out, as data may be the source's own buffer), and
+            # zero-pad if output is too short (may happen if not looping / end
+            # of buffer)
+            out[:filled] *= self.gain
+            out[filled:] = 0
 
             # return
-            return (output, continue_flag)
+            return continue_flag
 
 
 
@@ -87,33 +97,41 @@ class SpeedModulator(object):
         super(SpeedModulator, self).__init__()
         self.generator = generator
         self.speed = speed
+        self.buffer = None
+        self.ranges = (None, None)
 
     def set_speed(self, speed) :
         self.speed = speed
 
     def generate(self, num_frames, num_channels) :
+        output = np.empty(num_channels * num_frames, dtype=np.float32)
+        continue_flag = self.generate_into(output, num_frames, num_channels)
+        return (output, continue_flag)
+
+    def generate_into(self, out, num_frames, num_channels) :
         # optimization if speed is 1.0
         if self.speed == 1.0:
-            return self.generator.generate(num_frames, num_channels)
+            return generate_into(self.generator, out, num_frames, num_channels)
 
         # otherwise, we need to ask self.generator for a number of frames that is
         # larger or smaller than num_frames, depending on self.speed
         adj_frames = int(round(num_frames * self.speed))
 
         # get data from generator
-        data, continue_flag = self.generator.generate(adj_frames, num_channels)
-
-        # split into multi-channels:
-        data_chans = [ data[n::num_channels] for n in range(num_channels) ]
-
-        # stretch or squash data to fit exactly into num_frames
-        from_range = np.arange(adj_frames)
-        to_range = np.arange(num_frames) * (float(adj_frames) / num_frames)
-        resampled = [ np.interp(to_range, from_range, data_chans[n]) for n in range(num_channels) ]
-
-        # convert back by interleaving into a single buffer
-        output = np.empty(num_channels * num_frames, dtype=np.float32)
+        self.buffer = grow_buffer(self.buffer, num_channels * adj_frames)
+        data = self.buffer[:num_channels * adj_frames]
+        continue_flag = generate_into(self.generator, data, adj_frames, num_channels)
+
+        # stretch or squash data to fit exactly into num_frames. The ranges
+        # only change with adj_frames / num_frames.
+        if self.ranges[:2] != (adj_frames, num_frames):
+            from_range = np.arange(adj_frames)
+            to_range = np.arange(num_frames) * (float(adj_frames) / num_frames)
+            self.ranges = (adj_frames, num_frames, from_range, to_range)
+        from_range, to_range = self.ranges[2:]
+
+        # resample each channel, interleaving into out
         for n in range(num_channels) :
-            output[n::num_channels] = resampled[n]
+            out[n::num_channels] = np.interp(to_range, from_range, data[n::num_channels])
 
-        return (output, continue_flag)
+        return continue_flag
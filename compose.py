@@ -0,0 +1,185 @@
+import argparse
+import cPickle as pickle
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+import autocomplete
+import timing
+from export import write_midi
+
+# Headless composer: runs autocomplete beat after beat as fast as it can,
+# without Kivy or audio, and reports how long it took.
+#
+#   python compose.py jazz --beats 64 --output piece.mid
+#   python compose.py classical --fix 8=V|C --fix 9=I|C --output piece.pickle
+#
+# With --pieces, generates that many independent pieces across a process
+# pool instead, each from its own seed, and streams them to sharded pickle
+# files plus a manifest as they finish:
+#
+#   python compose.py jazz --pieces 10000 --seed 0 --out-dir dataset
+
+DEFAULT_SEED_BEAT = {'s': (72,), 'a': (67,), 't': (64,), 'b': (60,), 'harmony': 'I|C'}
+
+def beat_is_filled(beat):
+    for key in ['s', 'a', 't', 'b', 'harmony']:
+        if key not in beat:
+            return False
+    return True
+
+# Fills in data (a list of beats whose first beat is complete) up to beats
+# beats, the way BeatManager does during playback: each beat is
+# autocompleted from a window starting at the beat before it. With a seed,
+# each beat draws from its own beat_rng, so the piece is reproducible.
+def compose(data, beats, lookahead=16, seed=None):
+    data = [dict(beat) for beat in data]
+    for beat_index in range(1, beats):
+        while len(data) < beat_index - 1 + lookahead:
+            data.append({})
+        if beat_is_filled(data[beat_index]):
+            continue
+        window = data[beat_index - 1:beat_index - 1 + lookahead]
+        data[beat_index].update(autocomplete.autocomplete(window, rng=autocomplete.beat_rng(seed, beat_index))[1])
+    return data[:beats]
+
+def parse_beat(harmony, notes):
+    beat = {'harmony': harmony}
+    if notes:
+        for part, note in zip('satb', notes.split(',')):
+            beat[part] = (int(note),)
+    return beat
+
+def write(data, filename, tempo):
+    if filename.endswith('.mid'):
+        write_midi(data, filename, tempo)
+    else:
+        pickle.dump(data, open(filename, 'w'))
+
+def _init_worker(style, profiling, joint):
+    autocomplete.autocomplete_config(style)
+    autocomplete.joint_search = joint
+    timing.enable(profiling)
+
+def _generate_piece(job):
+    index, seed, data, beats, lookahead = job
+    piece = compose(data, beats, lookahead, seed)
+    return index, seed, piece, timing.collect(), autocomplete.collect_cache_stats()
+
+# Seed of piece index in a run seeded with seed. Drawn from both, so runs
+# with nearby seeds don't make the same pieces shifted by one.
+def seed_for_piece(seed, index):
+    return int(np.random.RandomState([seed, index]).randint(2 ** 31))
+
+# Generates pieces in parallel. Piece i is seeded with seed_for_piece(seed, i),
+# so its content doesn't depend on which process made it or in what order. Pieces
+# are written to out_dir in shards of shard_size as soon as they finish,
+# and out_dir/manifest.json lists which pieces and seeds are in each shard.
+def generate_dataset(style, data, pieces, beats, lookahead, seed, out_dir, shard_size, processes=None):
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    manifest = {
+        'style': style,
+        'beats': beats,
+        'lookahead': lookahead,
+        'seed': seed,
+        'piece_seed': 'RandomState([seed, index]).randint(2 ** 31)',
+        'pieces': pieces,
+        'shards': [],
+    }
+
+    def write_shard(shard):
+        filename = 'shard-{:05d}.pickle'.format(len(manifest['shards']))
+        pickle.dump(shard, open(os.path.join(out_dir, filename), 'wb'), pickle.HIGHEST_PROTOCOL)
+        manifest['shards'].append({
+            'file': filename,
+            'pieces': [piece['index'] for piece in shard],
+            'seeds': [piece['seed'] for piece in shard],
+        })
+
+    jobs = ((index, seed_for_piece(seed, index), data, beats, lookahead) for index in range(pieces))
+    pool = multiprocessing.Pool(processes, _init_worker, (style, timing.enabled, autocomplete.joint_search))
+    shard = []
+    try:
+        for index, piece_seed, piece, timings, cache_stats in pool.imap_unordered(_generate_piece, jobs):
+            timing.merge(timings)
+            autocomplete.merge_cache_stats(cache_stats)
+            shard.append({'index': index, 'seed': piece_seed, 'beats': piece})
+            if len(shard) >= shard_size:
+                write_shard(shard)
+                shard = []
+        if shard:
+            write_shard(shard)
+    finally:
+        pool.close()
+        pool.join()
+
+    json.dump(manifest, open(os.path.join(out_dir, 'manifest.json'), 'w'), indent=2)
+    return manifest
+
+def report(beats, elapsed, profile=None):
+    print '{} beats in {:.3f}s ({:.1f} beats/s)'.format(beats, elapsed, beats / elapsed)
+    print timing.report_text()
+    for name, (hits, misses) in sorted(autocomplete.cache_stats().items()):
+        if hits + misses:
+            print '{:<16} cache {:>8} hits {:>8} misses ({:.0%} hit rate)'.format(
+                name, hits, misses, hits / float(hits + misses))
+    if profile:
+        timing.export(profile)
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a piece without the UI.')
+    parser.add_argument('style', nargs='?', default='jazz', help='style module (jazz or classical)')
+    parser.add_argument('--beats', type=int, default=32, help='length of the piece in beats')
+    parser.add_argument('--harmony', default=DEFAULT_SEED_BEAT['harmony'], help='harmony of the first beat, eg I|C')
+    parser.add_argument('--notes', default='72,67,64,60', help='s,a,t,b notes of the first beat')
+    parser.add_argument('--constraints', help='pickled list of beats (as saved with r) fixed from beat 1 on')
+    parser.add_argument('--fix', action='append', default=[], metavar='BEAT=HARMONY', help='fix the harmony of a beat')
+    parser.add_argument('--lookahead', type=int, default=16, help='beats of lookahead for the harmony search')
+    parser.add_argument('--seed', type=int, help='random seed')
+    parser.add_argument('--tempo', type=int, default=120, help='tempo written to MIDI output')
+    parser.add_argument('--output', help='.mid for MIDI, anything else for a pickled list of beats')
+    parser.add_argument('--pieces', type=int, help='generate this many pieces in parallel instead of one')
+    parser.add_argument('--out-dir', default='dataset', help='where --pieces writes its shards and manifest')
+    parser.add_argument('--shard-size', type=int, default=100, help='pieces per shard file')
+    parser.add_argument('--processes', type=int, help='worker processes for --pieces (default: one per core)')
+    parser.add_argument('--joint', action='store_true', help='choose harmony and voicing together (see autocomplete.enumerate_joint)')
+    parser.add_argument('--profile', metavar='BASENAME', help='also write the stage timings to BASENAME.txt and BASENAME.json')
+    args = parser.parse_args()
+
+    timing.enable()
+    autocomplete.joint_search = args.joint
+
+    data = [parse_beat(args.harmony, args.notes)]
+    if args.constraints:
+        data += pickle.load(open(args.constraints, 'r'))
+    for fix in args.fix:
+        beat_index, harmony = fix.split('=')
+        beat_index = int(beat_index)
+        data += [{} for i in range(beat_index + 1 - len(data))]
+        data[beat_index]['harmony'] = harmony
+
+    if args.pieces:
+        start = time.time()
+        manifest = generate_dataset(args.style, data, args.pieces, args.beats, args.lookahead,
+                                    args.seed or 0, args.out_dir, args.shard_size, args.processes)
+        elapsed = time.time() - start
+        print '{} pieces in {} shards'.format(args.pieces, len(manifest['shards']))
+        report(args.pieces * (args.beats - 1), elapsed, args.profile)
+        return
+
+    autocomplete.autocomplete_config(args.style)
+
+    start = time.time()
+    data = compose(data, args.beats, args.lookahead, args.seed)
+    elapsed = time.time() - start
+
+    report(args.beats - 1, elapsed, args.profile)
+    if args.output:
+        write(data, args.output, args.tempo)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import ctypes
+import multiprocessing
+import struct
+
+# Single-producer single-consumer ring of fixed-size event records in shared
+# memory, for the UI to control the audio process. The UI thread is the only
+# writer and the audio thread the only reader, so no lock is needed: the
+# writer fills a slot before advancing head, and the reader reads a slot
+# before advancing tail. A full ring drops the event and counts it in
+# overflows instead of blocking the UI.
+#
+# Every record is (kind, channel, note, volume, a, b):
+#
+#   NOTE      : play note on channel from tick a to tick b, sent ahead of
+#               time
+#   NOTE_ON   : start note now
+#   NOTE_OFF  : stop note, a seconds from now
+#   TEMPO     : set the tempo to a bpm, with the sender at tick
+#               b + a * 8 * time.time() (so the audio can match its ticks)
+#   TRANSPORT : resume (a = 1) or pause (a = 0) playback
+#   QUIT      : shut the audio process down
+
+NOTE, NOTE_ON, NOTE_OFF, TEMPO, TRANSPORT, QUIT = range(6)
+
+RECORD = struct.Struct('<BBBBxxxxdd')
+CAPACITY = 1024
+
+class EventRing(object):
+    def __init__(self, capacity=CAPACITY):
+        super(EventRing, self).__init__()
+        self.capacity = capacity
+        self.records = multiprocessing.RawArray(ctypes.c_char, capacity * RECORD.size)
+        # events ever written / read, and dropped because the ring was full
+        self.head = multiprocessing.RawValue(ctypes.c_uint64, 0)
+        self.tail = multiprocessing.RawValue(ctypes.c_uint64, 0)
+        self.overflow = multiprocessing.RawValue(ctypes.c_uint64, 0)
+
+    # writer side. Returns False if the ring was full.
+    def put(self, kind, channel=0, note=0, volume=0, a=0., b=0.):
+        head = self.head.value
+        if head - self.tail.value >= self.capacity:
+            self.overflow.value += 1
+            return False
+        RECORD.pack_into(self.records, head % self.capacity * RECORD.size, kind, channel, note, volume, a, b)
+        self.head.value = head + 1
+        return True
+
+    def note(self, channel, note, volume, start, end):
+        return self.put(NOTE, channel, note, volume, start, end)
+
+    def note_on(self, channel, note, volume):
+        return self.put(NOTE_ON, channel, note, volume)
+
+    def note_off(self, channel, note, delay=0.):
+        return self.put(NOTE_OFF, channel, note, 0, delay)
+
+    def tempo(self, bpm, origin):
+        return self.put(TEMPO, a=bpm, b=origin)
+
+    def transport(self, playing):
+        return self.put(TRANSPORT, a=1. if playing else 0.)
+
+    def quit(self):
+        return self.put(QUIT)
+
+    # reader side: every record written so far, oldest first
+    def drain(self):
+        tail = self.tail.value
+        head = self.head.value
+        records = [
+            RECORD.unpack_from(self.records, idx % self.capacity * RECORD.size)
+            for idx in xrange(tail, head)
+        ]
+        self.tail.value = head
+        return records
+
+    def overflows(self):
+        return self.overflow.value
@@ -0,0 +1,36 @@
+from midiutil import MidiFile
+
+# Writes a list of beats (the same data structure BeatManager keeps) to a
+# four-track MIDI file, one track per part.
+def write_midi(data, filename, tempo=120):
+    midi_file = MidiFile.MIDIFile(4)
+    midi_file.addTrackName(0,0,"Soprano")
+    midi_file.addTrackName(1,0,"Alto")
+    midi_file.addTrackName(2,0,"Tenor")
+    midi_file.addTrackName(3,0,"Bass")
+    midi_file.addTempo(0,0,tempo)
+    midi_file.addTempo(1,0,tempo)
+    midi_file.addTempo(2,0,tempo)
+    midi_file.addTempo(3,0,tempo)
+
+    for beat_idx, beat in enumerate(data):
+        for track, part in enumerate('satb'):
+            if part in beat:
+                num = len(beat[part])
+                notes = []
+                starts = []
+                lengths = []
+                for idx, note in enumerate(beat[part]):
+                    if note == -1:
+                        lengths[-1] += 1
+                    elif note == None:
+                        pass
+                    else:
+                        notes.append(note)
+                        starts.append(idx)
+                        lengths.append(1)
+                for idx, note in enumerate(notes):
+                    midi_file.addNote(track, 0, note, beat_idx + float(starts[idx]) / num, float(lengths[idx]) / num, 127)
+    diskfile = open(filename, 'wb')
+    midi_file.writeFile(diskfile)
+    diskfile.close()
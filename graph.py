@@ -0,0 +1,137 @@
+import numpy as np
+
+from pitchclass import pcs_of, notes_mask
+
+# Compiles a style module (jazz, classical) into integer tables so the path
+# search never has to split or format "chord|key" strings.
+#
+#   harmonies[id]       : "chord|key" string for each harmony id
+#   ids[harmony]        : inverse of harmonies
+#   indptr, indices     : CSR adjacency, the transitions out of harmony id h
+#                         go to indices[indptr[h]:indptr[h + 1]]
+#   costs               : transition cost of each edge, parallel to indices
+#   sources             : harmony id each edge leaves from, parallel to indices
+#   pcs                 : 12-bit pitch-class mask of each harmony's chord tones
+#   dissonance          : config._dissonance of each harmony
+#   key_changes[key][r] : key reached from key by the roman numeral r
+#   scales[key]         : 12-bit pitch-class mask of each key's scale
+#   ranges[part]        : MIDI notes part can sing, as an array
+#   range_masks[part]   : the same notes as a 128-bit mask
+#   chord_ranges[h]     : for each part, the notes in its range that are
+#                         chord tones of harmony id h
+#   chord_range_table[p]: chord_ranges of part p for every harmony id as one
+#                         array, padded with -1
+class HarmonyGraph(object):
+    def __init__(self, config):
+        super(HarmonyGraph, self).__init__()
+        self.config = config
+
+        self.key_changes = {
+            key: {
+                root: config._key_change(key, root)
+                for root in self._roots()
+            }
+            for key in config._keys
+        }
+
+        # every chord the style knows in every key, plus whatever the
+        # transitions can reach from there
+        self.harmonies = sorted({
+            "{}|{}".format(chord, key)
+            for key in config._keys
+            for chord in config._transitions[key]
+        })
+        self.ids = {
+            harmony: idx
+            for idx, harmony in enumerate(self.harmonies)
+        }
+        edges = []
+        idx = 0
+        while idx < len(self.harmonies):
+            harmony = self.harmonies[idx]
+            chord, key = harmony.split('|')
+            for transition, cost in sorted(config._transitions[key].get(chord, {}).items()):
+                edges.append((idx, self.id(self.apply_transition(harmony, transition)), cost))
+            idx += 1
+
+        self.size = len(self.harmonies)
+        src, dst, cost = zip(*edges)
+        self.indptr = np.searchsorted(np.array(src), np.arange(self.size + 1)).astype(np.int32)
+        self.indices = np.array(dst, dtype=np.int32)
+        self.costs = np.array(cost, dtype=float)
+        self.sources = np.array(src, dtype=np.int32)
+        self.pcs = np.array([
+            pcs_of(self.notes(harmony))
+            for harmony in self.harmonies
+        ], dtype=np.uint16)
+        self.dissonance = np.array([
+            config._dissonance(harmony)
+            for harmony in self.harmonies
+        ])
+
+        self.scales = {
+            key: pcs_of(config._scale(key))
+            for key in config._keys
+        }
+        self.ranges = {
+            part: np.array(config._ranges[part])
+            for part in 'satb'
+        }
+        self.range_masks = {
+            part: notes_mask(config._ranges[part])
+            for part in 'satb'
+        }
+        members = {
+            part: (self.pcs[:, None] >> (notes % 12)) & 1 == 1
+            for part, notes in self.ranges.items()
+        }
+        self.chord_ranges = [
+            [self.ranges[part][members[part][idx]] for part in 'satb']
+            for idx in range(self.size)
+        ]
+        self.chord_range_table = {}
+        for k, part in enumerate('satb'):
+            width = max(len(ranges[k]) for ranges in self.chord_ranges)
+            table = np.full((self.size, max(width, 1)), -1)
+            for idx, ranges in enumerate(self.chord_ranges):
+                table[idx, :len(ranges[k])] = ranges[k]
+            self.chord_range_table[part] = table
+
+    def _roots(self):
+        return {
+            transition.split('|')[1]
+            for key in self.config._transitions
+            for chords in self.config._transitions[key].values()
+            for transition in chords
+            if '|' in transition
+        }
+
+    def id(self, harmony):
+        # harmonies reached only through a transition get appended as they
+        # are found, so ids stay dense
+        if harmony not in self.ids:
+            self.ids[harmony] = len(self.harmonies)
+            self.harmonies.append(harmony)
+        return self.ids[harmony]
+
+    def apply_transition(self, harmony, transition):
+        key = harmony.split('|')[-1]
+        if '|' in transition:
+            new_chord, key_change = transition.split('|')
+            return "{}|{}".format(new_chord, self.key_changes[key][key_change])
+        return "{}|{}".format(transition, key)
+
+    def notes(self, harmony):
+        chord, key = harmony.split('|')
+        return {
+            (self.config._keys[key] + note) % 12
+            for note in self.config._notes[key].get(chord, ())
+        }
+
+    def successors(self, harmony_id):
+        lo, hi = self.indptr[harmony_id], self.indptr[harmony_id + 1]
+        return self.indices[lo:hi], self.costs[lo:hi]
+
+
+def compile_style(config):
+    return HarmonyGraph(config)
@@ -2,36 +2,49 @@ import sys
 import random
 import numpy as np
 import bisect
-import copy
+import heapq
 import multiprocessing
+import threading
 import time
-import Queue
 import cPickle as pickle
-from midiutil import MidiFile
 
 from kivy.uix.floatlayout import FloatLayout
 
 from common.core import *
 from common.audio import Audio
 from common.synth import Synth
-from common.clock import SimpleTempoMap, AudioScheduler, Scheduler, Clock
+from common.clock import SimpleTempoMap, AudioScheduler, Scheduler, Clock, kTicksPerQuarter
 from common.gfxutil import AnimGroup
 
 from input import Input, input_config
 from ui import UI
-from autocomplete import autocomplete, autocomplete_config
+from autocomplete import autocomplete_config, input_key, likely_inputs
+from beat import Beat, EMPTY
+import events
+from events import EventRing
+from score import ScoreStore
+from workers import AutocompletePool
+from export import write_midi
+import timing
 
 config = __import__('jazz')
 
-if len(sys.argv) >= 2:
-    autocomplete_config(sys.argv[1])
-    input_config(sys.argv[1])
-    config = __import__(sys.argv[1])
+# main.py [style [seed]] [--joint]: a seed replays a session, and --joint
+# chooses harmony and voicing together
+joint = '--joint' in sys.argv
+args = [arg for arg in sys.argv[1:] if arg != '--joint']
 
-QUIT = multiprocessing.Queue()
+if len(args) >= 1:
+    autocomplete_config(args[0])
+    input_config(args[0])
+    config = __import__(args[0])
+
+seed = None
+if len(args) >= 2:
+    seed = int(args[1])
 
 class BeatManager:
-    def __init__(self, tempo=80, instruments={'s': 0, 'a': 0, 't': 0, 'b': 0}, on_beat_callback=lambda : None):
+    def __init__(self, tempo=80, instruments={'s': 0, 'a': 0, 't': 0, 'b': 0}, on_beat_callback=lambda : None, style='jazz', seed=None, joint=False):
 
         # Data structure
         # This data structure describes a partial or full composition
@@ -48,20 +61,33 @@ class BeatManager:
         #   'mel_rhythm' : tuple     # template for s line, but with boolean values
         #   'acc_rhythm' : dict         # template for atb lines, but with booleans (-1 is hold previous)
         # }
+        # Beats are stored as immutable Beats (see beat.py), so edits replace
+        # the beat with beat.merge(...) instead of updating it in place, and
+        # a slice of data is a snapshot that can be sent to the workers as is.
+        # data is a ScoreStore (see score.py), which keeps the beats around
+        # the playhead in memory and older ones on disk.
 
         # Set initial data
-        self.data = [{'s': (72,), 'a': (67,), 't': (64,), 'b': (60,), 'harmony': 'I|C'}, {}, {}, {}, {}, {}, {}]
+        self.data = ScoreStore([Beat({'s': (72,), 'a': (67,), 't': (64,), 'b': (60,), 'harmony': 'I|C'})] + [EMPTY] * 6)
 
         # Class constants
         self.PADDING = 17
-        self.MAX_AUTOCOMPLETE = 5
+        self.MAX_AUTOCOMPLETE = 16
+        self.AUTOCOMPLETE_MARGIN = .05 # seconds before a beat plays that its notes are sent to the audio process
+        self.SPECULATIVE_GUESSES = 4 # likely inputs precomputed for the selected beat
 
         # Class variables
         self.on_beat_callback = on_beat_callback
         self.current_beat_index = 0
         self.needs_autocomplete_update = True
         self.current_playing_notes = set()
-        self.autocomplete_data = multiprocessing.Queue()
+        self.provisional_beats = set() # beats filled by a search that was cut short
+        self.speculation = None # (beat index, parts, window) being precomputed for
+        # every beat's random choices derive from this, so a session can be replayed
+        self.seed = random.randrange(1 << 31) if seed is None else seed
+        self.autocomplete_pool = AutocompletePool(style, joint=joint)
+        register_terminate_func(self.autocomplete_pool.close)
+        register_terminate_func(self.write_profile)
 
         self.clock = Clock()
         self.last_tick = 0
@@ -69,6 +95,7 @@ class BeatManager:
         self.tempo_map = SimpleTempoMap(tempo)
         self.sched = Scheduler(self.clock, self.tempo_map)
         self.sched.post_at_tick(480, self.on_beat)
+        self.sched.post_at_tick(self.send_tick(480), self.send_beat, 480)
         self.paused = False
         self.improv = False
 
@@ -76,96 +103,121 @@ class BeatManager:
         self.synth.program(0, 0, 0)
         self.set_instruments(instruments)
 
-        self.note_queue = multiprocessing.Queue()
-        self.note_on = multiprocessing.Queue()
-        self.note_off = multiprocessing.Queue()
-        self.tempo_queue = multiprocessing.Queue()
+        # Everything the audio process is told goes through this one ring
+        # (see events.py), written only from the UI thread
+        self.events = EventRing()
+        # events dropped because the ring was full, as last reported
+        self.dropped_events = 0
+        register_terminate_func(self.events.quit)
+        self.events.tempo(self.tempo, self.tick_origin())
         print sys.platform
         if sys.platform == 'darwin':
         	# Use threads instead of processes (PyAudio on Mac doesn't support multiprocessing w/ forking)
-        	from threading import Thread
-        	audio_process = Thread(target=self.audio_process, args=(self.note_queue,))
+        	audio_process = threading.Thread(target=self.audio_process)
         else:
-        	audio_process = multiprocessing.Process(target=self.audio_process, args=(self.note_queue,))
+        	audio_process = multiprocessing.Process(target=self.audio_process)
         audio_process.start()
         
     def set_tempo(self, tempo):
         tempo = np.clip(tempo, 0, 200)
         self.tempo = tempo
         self.tempo_map.set_tempo(tempo, self.clock.get_time())
-        self.tempo_queue.put(tempo)
+        self.events.tempo(tempo, self.tick_origin())
+
+    # the UI's tick at wall-clock time 0 (tick = origin + ticks per second *
+    # time.time()), for the audio process to line its ticks up with
+    def tick_origin(self):
+        slope = kTicksPerQuarter * self.tempo_map.bpm / 60.
+        return self.tempo_map.time_to_tick(self.clock.get_time()) - slope * time.time()
 
     def toggle_pause(self):
         self.paused = not self.paused
         if self.paused:
             self.tempo_map.set_tempo(0, self.clock.get_time())
-            self.tempo_queue.put(1e-9)
         else:
             self.set_tempo(self.tempo)
-            self.tempo_queue.put(self.tempo)
+        self.events.transport(not self.paused)
 
     def toggle_improv(self):
         self.improv = not self.improv
 
-    def audio_process(self, note_queue):
-        # Initialize audio
-        audio = Audio(2)
-        sched = Scheduler(Clock(), self.tempo_map)
+    def audio_process(self):
+        # Notes are timed by an AudioScheduler, which counts rendered frames
+        # and splits the synth's output at the exact frame each note starts
+        # or stops, whatever the buffer size.
+        # the audio process keeps its own tempo map, whose ticks are lined up
+        # with the UI's whenever the tempo is set
+        self.audio_tempo_map = SimpleTempoMap(self.tempo)
+        self.audio_sched = AudioScheduler(self.audio_tempo_map)
+        self.active_notes = set()
+        self.delayed_noteoffs = [] # heap of (frame, channel, note)
+        self.audio_tempo = self.tempo
+        self.audio_origin = 0
+        self.audio_quit = threading.Event()
+
+        # Initialize audio. The device asks for each buffer from the audio
+        # thread, which first applies every event that has arrived since the
+        # last one, so events are delayed by at most one buffer.
+        audio = Audio(2, callback=True, control_func=self.audio_control)
 
         # Connect scheduler into audio system
-        audio.set_generator(self.synth)
+        self.audio_sched.set_generator(self.synth)
+        audio.set_generator(self.audio_sched)
 
-        active_notes = set()
+        # Event.wait() without a timeout can't be interrupted in Python 2
+        while not self.audio_quit.wait(1):
+            pass
+        audio.close()
+
+    # Called by the audio thread before each buffer. Drains the event ring;
+    # notes arrive ahead of time with the ticks they start and stop on, and
+    # are posted on the AudioScheduler at exactly those ticks.
+    def audio_control(self):
+        for kind, channel, note, volume, a, b in self.events.drain():
+            if kind == events.NOTE:
+                self.audio_sched.post_at_tick(a, self._synth_noteon, (channel, note, volume))
+                self.audio_sched.post_at_tick(b, self._synth_noteoff, (channel, note))
+            elif kind == events.NOTE_ON:
+                self._synth_noteon(None, (channel, note, volume))
+            elif kind == events.NOTE_OFF:
+                frame = self.audio_sched.cur_frame + int(a * Audio.sample_rate)
+                heapq.heappush(self.delayed_noteoffs, (frame, channel, note))
+            elif kind == events.TEMPO:
+                self.audio_tempo = a
+                self.audio_origin = b
+                self.set_audio_tempo(a)
+            elif kind == events.TRANSPORT:
+                self.set_audio_tempo(self.audio_tempo if a else 0)
+            elif kind == events.QUIT:
+                self.audio_quit.set()
+
+        while self.delayed_noteoffs and self.delayed_noteoffs[0][0] <= self.audio_sched.cur_frame:
+            frame, channel, note = heapq.heappop(self.delayed_noteoffs)
+            self._synth_noteoff(None, (channel, note))
+
+    # a (near) zero tempo stops playback and silences what was playing.
+    # Otherwise the audio's ticks are lined up with the UI's (from the origin
+    # sent with the tempo), so the ticks notes are sent with match.
+    def set_audio_tempo(self, tempo):
+        now = self.audio_sched.get_time()
+        if tempo < 1e-3:
+            for channel, note in self.active_notes:
+                self.synth.noteoff(channel, note)
+            self.active_notes.clear()
+            self.audio_tempo_map.set_tempo(1e-9, now)
+            return
+        self.audio_tempo_map.set_tempo(tempo, now)
+        ui_tick = self.audio_origin + kTicksPerQuarter * tempo / 60. * time.time()
+        self.audio_tempo_map.tick_offset += ui_tick - self.audio_tempo_map.time_to_tick(now)
 
-        while True:
-            try:
-                channel, note, volume, start, length = note_queue.get(False)
-                tick = sched.get_tick()
-                sched.post_at_tick(tick + start * 480, self._noteon, (channel, note, volume))
-                sched.post_at_tick(tick + length * 480, self._noteoff, (channel, note))
-            except Queue.Empty:
-                pass
+    # run on the audio thread
+    def _synth_noteon(self, tick, (channel, note, volume)):
+        self.synth.noteon(channel, note, volume)
+        self.active_notes.add((channel, note))
 
-            try:
-                channel, note = self.note_off.get(False)
-                self.synth.noteoff(channel, note)
-                if (channel, note) in active_notes:
-                    active_notes.remove((channel, note))
-            except Queue.Empty:
-                pass
-
-            try:
-                channel, note, volume = self.note_on.get(False)
-                self.synth.noteon(channel, note, volume)
-                active_notes.add((channel, note))
-            except Queue.Empty:
-                pass
-
-            try:
-                tempo = self.tempo_queue.get(False)
-                if tempo < 1e-3:
-                    for channel, note in active_notes:
-                        self.synth.noteoff(channel, note)
-                    active_notes = set()
-                self.tempo_map.set_tempo(tempo, self.clock.get_time())
-            except Queue.Empty:
-                pass
-
-            try:
-                QUIT.get(False)
-                QUIT.put(None)
-                return
-            except Queue.Empty:
-                audio.on_update()
-                sched.on_update()
-                time.sleep(.01)
-
-    def _noteon(self, tick, (channel, note, volume)):
-        self.note_on.put((channel, note, volume))
-
-    def _noteoff(self, tick, (channel, note), sleep=0):
-        time.sleep(sleep)
-        self.note_off.put((channel, note))
+    def _synth_noteoff(self, tick, (channel, note)):
+        self.synth.noteoff(channel, note)
+        self.active_notes.discard((channel, note))
 
     def set_instruments(self, instruments):
         self.instruments = instruments
@@ -179,6 +231,14 @@ class BeatManager:
     def current_key(self):
         return self.data[self.current_beat_index]['harmony'].split('|')[1]
 
+    # wall-clock time at which beat_index starts playing, None while paused
+    # or stopped at tempo 0
+    def beat_time(self, beat_index):
+        if self.paused or self.tempo_map.bpm < 1e-3:
+            return None
+        beat_tick = (beat_index + 1) * kTicksPerQuarter
+        return time.time() + self.tempo_map.tick_to_time(beat_tick) - self.clock.get_time()
+
     def beat_is_filled(self, beat_index):
         for key in ['s', 'a', 't', 'b', 'harmony']:
             if key not in self.data[beat_index]:
@@ -186,17 +246,31 @@ class BeatManager:
         return True
 
     def on_beat(self, tick, _ = None):
-        # fill beat if not already autocompleted
-        if not self.beat_is_filled(self.current_beat_index):
-            self.data[self.current_beat_index].update(self.data[self.current_beat_index - 1])
-
-        self.play_next_beat()
         self.sched.post_at_tick(tick + 480, self.on_beat)
         self.on_beat_callback()
         self.current_beat_index += 1
         self.autocomplete_beat(self.current_beat_index)
 
-    def play_next_beat(self):
+    # tick at which the beat starting on beat_tick is sent to the audio
+    # process, AUTOCOMPLETE_MARGIN seconds ahead at the current tempo
+    def send_tick(self, beat_tick):
+        return beat_tick - self.AUTOCOMPLETE_MARGIN * kTicksPerQuarter * self.tempo_map.bpm / 60.
+
+    # Sends the current beat, which starts playing on beat_tick, ahead of
+    # time: the audio process starts its notes on their exact ticks however
+    # late in a frame this runs. The beat can't change from here on.
+    def send_beat(self, tick, beat_tick):
+        # fill beat if not already autocompleted
+        if not self.beat_is_filled(self.current_beat_index):
+            self.data[self.current_beat_index] = self.data[self.current_beat_index].merge(self.data[self.current_beat_index - 1])
+
+        self.play_next_beat(beat_tick)
+        self.autocomplete_pool.cancel(self.current_beat_index)
+        self.provisional_beats.discard(self.current_beat_index)
+        next_tick = beat_tick + 480
+        self.sched.post_at_tick(self.send_tick(next_tick), self.send_beat, next_tick)
+
+    def play_next_beat(self, beat_tick):
         ## Stop playing any previous notes
         #for channel, note in self.current_playing_notes:
         #    self.synth.noteoff(channel, note)
@@ -225,26 +299,104 @@ class BeatManager:
                 else:
                     volume = 100 if 'manual' in next_beat and part in next_beat['manual'] else 80
                 for idx, note in enumerate(notes):
-                    self.note_queue.put((channel, note, volume, float(starts[idx]) / num, float(lengths[idx]) / num))
+                    start = beat_tick + 480 * starts[idx] / float(num)
+                    self.events.note(channel, note, volume, start, start + 480 * lengths[idx] / float(num))
                 #self.synth.noteon(channel, next_beat[part][0], 100)
                 #self.current_playing_notes.add((channel, next_beat[part][0]))
 
-    def autocomplete_thread(self, beat_index, data):
-        autocomplete_data = autocomplete(data)[1]
-        self.autocomplete_data.put((beat_index, autocomplete_data, np.random.get_state()))
-
     def autocomplete_beat(self, beat_index):
         # Pad data with empty beats
         while len(self.data) < beat_index + self.PADDING:
-            self.data.append({})
+            self.data.append(EMPTY)
 
         # Don't autocomplete if beat is already filled in
         if self.beat_is_filled(beat_index):
             return
 
-        # Fill in beat based on the beats immediately before & after
-        process = multiprocessing.Process(target=self.autocomplete_thread, args=(beat_index, copy.deepcopy(self.data[beat_index - 1 :beat_index - 1 + self.MAX_AUTOCOMPLETE])))
-        process.start()
+        # Fill in beat based on the beats immediately before & after. Ask for
+        # a first answer halfway to the beat, and a better one if there's
+        # time left before it plays.
+        playback = self.beat_time(beat_index)
+        deadline = None
+        if playback is not None:
+            playback -= self.AUTOCOMPLETE_MARGIN
+            deadline = (time.time() + playback) / 2
+        self.autocomplete_pool.submit(beat_index, self.data[beat_index - 1 :beat_index - 1 + self.MAX_AUTOCOMPLETE], deadline, playback, self.seed)
+
+    # An edit to edited_index changes the input of every job whose window
+    # covers it. Those jobs are superseded with a fresh snapshot, or just
+    # cancelled if the edit filled in their beat.
+    def invalidate_autocomplete(self, edited_index):
+        for beat_index in self.autocomplete_pool.active_beats():
+            if beat_index - 1 <= edited_index < beat_index - 1 + self.MAX_AUTOCOMPLETE:
+                self.autocomplete_pool.cancel(beat_index)
+                self.provisional_beats.discard(beat_index)
+                self.autocomplete_beat(beat_index)
+
+    # The window autocomplete sees for beat_index, with the beat itself cut
+    # down to what the user entered
+    def speculation_window(self, beat_index):
+        while len(self.data) < beat_index + self.PADDING:
+            self.data.append(EMPTY)
+        window = self.data[beat_index - 1:beat_index - 1 + self.MAX_AUTOCOMPLETE]
+        window[1] = window[1].select(window[1].get('manual', frozenset()) | {'manual'})
+        return window
+
+    # While no beat is waiting on autocomplete, precompute beat_index for the
+    # inputs the user is likeliest to enter into parts next, so that a
+    # matching input can be filled in at once. Call every frame. Only soprano
+    # and harmony inputs are guessed, so nothing is precomputed while other
+    # parts are enabled: their inputs could never match a guess.
+    def speculate(self, beat_index, parts):
+        if not parts or not parts <= {'s', 'harmony'}:
+            return
+        if self.autocomplete_pool.active_beats() or not self.beat_is_filled(beat_index - 1):
+            return
+        window = self.speculation_window(beat_index)
+        if self.speculation == (beat_index, parts, window):
+            return
+        self.speculation = (beat_index, parts, window)
+        self.autocomplete_pool.speculate(beat_index, [
+            (input_key(guess), [window[0], window[1].merge(guess)] + window[2:])
+            for guess in likely_inputs(window, parts, self.SPECULATIVE_GUESSES)
+        ], self.seed)
+
+    # Called after the user's input (beat) has been written into beat_index.
+    # If it is one of the guesses and nothing else in the window has changed
+    # since, fill in the rest of the beat from the precomputed result.
+    def apply_speculation(self, beat_index, beat):
+        key = input_key(beat)
+        result = self.autocomplete_pool.speculated.get((beat_index, key))
+        if result is None or self.speculation is None or self.speculation[0] != beat_index:
+            return False
+        window = self.speculation_window(beat_index)
+        expected = self.speculation[2]
+        if window[0] != expected[0] or window[2:] != expected[2:]:
+            return False
+        if input_key(window[1]) != input_key(expected[1].merge(key)):
+            return False
+        current = self.data[beat_index]
+        manual = current.get('manual', frozenset())
+        self.data[beat_index] = current.merge({
+            key: value
+            for key, value in result.items()
+            if key not in manual and key != 'manual'
+        })
+        return True
+
+    # Autocomplete stage timings (see timing.py), gathered from the workers
+    # while profiling is on and written to profile.txt / profile.json.
+    # Turning profiling on starts a new window.
+    def toggle_profiling(self):
+        if not timing.enabled:
+            timing.reset()
+        self.autocomplete_pool.set_profiling(not timing.enabled)
+        print 'profiling', 'on' if timing.enabled else 'off'
+
+    def write_profile(self):
+        if timing.stages:
+            print timing.report_text()
+            timing.export('profile')
 
     def on_update(self):
         #self.audio.on_update()
@@ -253,21 +405,30 @@ class BeatManager:
         self.tick_delta = tick - self.last_tick
         self.last_tick = tick
 
+        dropped = self.events.overflows()
+        if dropped != self.dropped_events:
+            print 'audio events dropped:', dropped - self.dropped_events, '(%d total)' % dropped
+            self.dropped_events = dropped
+
         # Fill in any autocompleted beats
-        try:
-            beat, autocomplete_data, random_state = self.autocomplete_data.get(False)
-            np.random.set_state(random_state)
-            if not self.beat_is_filled(beat):
-                self.data[beat].update(autocomplete_data)
-        except Queue.Empty:
-            pass
+        # Beats filled by a search that was cut short can still be replaced by
+        # a better result until they are played.
+        for beat, autocomplete_data, complete in self.autocomplete_pool.poll():
+            provisional = beat in self.provisional_beats and beat >= self.current_beat_index
+            if not self.beat_is_filled(beat) or provisional:
+                self.data[beat] = self.data[beat].merge(autocomplete_data)
+                if complete:
+                    self.provisional_beats.discard(beat)
+                else:
+                    self.provisional_beats.add(beat)
 
 
 class MainWidget(BaseWidget):
     def __init__(self):
         super(MainWidget, self).__init__()
 
-        self.beat_manager = BeatManager(tempo=60, on_beat_callback=self.on_beat, instruments=config._instruments)
+        self.beat_manager = BeatManager(tempo=60, on_beat_callback=self.on_beat, instruments=config._instruments, style=config.__name__, seed=seed, joint=joint)
+        print 'session seed', self.beat_manager.seed
         self.input = Input(self.update_beat_from_input)
 
         # Draw the UI
@@ -300,14 +461,16 @@ class MainWidget(BaseWidget):
             for channel, part in enumerate('satb'):
                 if part in beat and 'manual' in beat and part in beat['manual']:
                     note = beat[part][0]
-                    self.beat_manager.note_on.put((channel, note, 100))
-                    process = multiprocessing.Process(target=self.beat_manager._noteoff, args=(0, (channel, note), .5))
-                    process.start()
+                    self.beat_manager.events.note_on(channel, note, 100)
+                    self.beat_manager.events.note_off(channel, note, .5)
 
         selected_beat_index = self.beat_manager.current_beat_index + 1 + self.ui.selected_beat
+        self.beat_manager.provisional_beats.discard(selected_beat_index)
         if 'manual' in beat and 'manual' in self.beat_manager.data[selected_beat_index]:
             beat['manual'].update(self.beat_manager.data[selected_beat_index]['manual'])
-        self.beat_manager.data[selected_beat_index].update(beat)
+        self.beat_manager.data[selected_beat_index] = self.beat_manager.data[selected_beat_index].merge(beat)
+        self.beat_manager.invalidate_autocomplete(selected_beat_index)
+        self.beat_manager.apply_speculation(selected_beat_index, beat)
         print("{}: {}".format(selected_beat_index, self.beat_manager.data[selected_beat_index])) # [DEBUGGING]
         self.ui.staff.add_beat(selected_beat_index, self.beat_manager.data[selected_beat_index])
 
@@ -346,74 +509,44 @@ class MainWidget(BaseWidget):
                 self.record_index = None
         if keycode[1] == 'l':
             data = pickle.load(open('recording.pickle', 'r'))
-            self.beat_manager.data += [{} for i in range(
+            self.beat_manager.data += [EMPTY] * (
                 self.beat_manager.current_beat_index + self.ui.selected_beat + 1 + len(data) - len(self.beat_manager.data)
-            )]
-            for i, (existing, recorded) in enumerate(zip(self.beat_manager.data[self.beat_manager.current_beat_index + self.ui.selected_beat + 1:], data)):
-                if 'manual' not in existing:
-                    existing['manual'] = set()
-                if 'manual' not in recorded:
-                    recorded['manual'] = set()
-                manual = {
-                    key: recorded[key]
-                    for key in recorded
-                }
-                existing.update(manual)
-                existing['manual'].update(recorded['manual'])
-                self.ui.staff.add_beat(self.beat_manager.current_beat_index + self.ui.selected_beat + 1 + i, existing)
+            )
+            for i, recorded in enumerate(data):
+                beat_index = self.beat_manager.current_beat_index + self.ui.selected_beat + 1 + i
+                existing = self.beat_manager.data[beat_index]
+                # every recorded key, including which ones were manual
+                manual = dict(recorded)
+                manual['manual'] = recorded.get('manual', frozenset())
+                self.beat_manager.data[beat_index] = existing.merge(manual)
+                self.beat_manager.invalidate_autocomplete(beat_index)
+                self.ui.staff.add_beat(beat_index, self.beat_manager.data[beat_index])
 
         if keycode[1] == 'e':
             data = pickle.load(open('recording.pickle', 'r'))
-            self.beat_manager.data += [{} for i in range(
+            self.beat_manager.data += [EMPTY] * (
                 self.beat_manager.current_beat_index + self.ui.selected_beat + 1 + len(data) - len(self.beat_manager.data)
-            )]
-            for i, (existing, recorded) in enumerate(zip(self.beat_manager.data[self.beat_manager.current_beat_index + self.ui.selected_beat + 1:], data)):
-                if 'manual' not in existing:
-                    existing['manual'] = set()
-                if 'manual' not in recorded:
-                    recorded['manual'] = set()
+            )
+            for i, recorded in enumerate(data):
+                beat_index = self.beat_manager.current_beat_index + self.ui.selected_beat + 1 + i
+                existing = self.beat_manager.data[beat_index]
+                # only the recorded keys that were manual
                 manual = {
                     key: recorded[key]
-                    for key in recorded['manual']
+                    for key in recorded.get('manual', ())
                 }
-                existing.update(manual)
-                existing['manual'].update(recorded['manual'])
-                self.ui.staff.add_beat(self.beat_manager.current_beat_index + self.ui.selected_beat + 1 + i, existing)
-
+                manual['manual'] = existing.get('manual', frozenset()) | frozenset(recorded.get('manual', ()))
+                self.beat_manager.data[beat_index] = existing.merge(manual)
+                self.beat_manager.invalidate_autocomplete(beat_index)
+                self.ui.staff.add_beat(beat_index, self.beat_manager.data[beat_index])
+
+        if keycode[1] == 'f':
+            self.beat_manager.toggle_profiling()
+        if keycode[1] == 'g':
+            self.beat_manager.write_profile()
         if keycode[1] == 'y':
-            midi_file = MidiFile.MIDIFile(4)
-            midi_file.addTrackName(0,0,"Soprano")
-            midi_file.addTrackName(1,0,"Alto")
-            midi_file.addTrackName(2,0,"Tenor")
-            midi_file.addTrackName(3,0,"Bass")
-            tempo = 120
-            midi_file.addTempo(0,0,tempo)
-            midi_file.addTempo(1,0,tempo)
-            midi_file.addTempo(2,0,tempo)
-            midi_file.addTempo(3,0,tempo)
-
             data = pickle.load(open('recording.pickle', 'r'))
-            for beat_idx, beat in enumerate(data):
-                for track, part in enumerate('satb'):
-                    if part in beat:
-                        num = len(beat[part])
-                        notes = []
-                        starts = []
-                        lengths = []
-                        for idx, note in enumerate(beat[part]):
-                            if note == -1:
-                                lengths[-1] += 1
-                            elif note == None:
-                                pass
-                            else:
-                                notes.append(note)
-                                starts.append(idx)
-                                lengths.append(1)
-                        for idx, note in enumerate(notes):
-                            midi_file.addNote(track, 0, note, beat_idx + float(starts[idx]) / num, float(lengths[idx]) / num, 127)
-            diskfile = open("recording.mid", 'wb')
-            midi_file.writeFile(diskfile)
-            diskfile.close()
+            write_midi(data, "recording.mid")
 
     def on_key_up(self, keycode):
         self.input.on_key_up(keycode)
@@ -423,10 +556,10 @@ class MainWidget(BaseWidget):
 
     def on_update(self):
         self.beat_manager.on_update()
+        self.beat_manager.speculate(self.beat_manager.current_beat_index + 1 + self.ui.selected_beat, self.input.parts_enabled)
         self.input.on_update()
         self.ui.on_update(self.beat_manager.tick_delta)
 
 if __name__ == "__main__":
     run(MainWidget)
-    QUIT.put(None)
 
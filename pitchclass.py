@@ -0,0 +1,38 @@
+import numpy as np
+
+# Pitch-class sets as 12-bit integers: bit n is set when pitch class n
+# (C = 0, C# = 1, ...) is in the set. Membership, coverage and comparison of
+# chords and scales are then single bitwise operations.
+#
+#   pcs_of([60, 64, 67])        -> 0b000010010001 (C major triad)
+#   contains(mask, note)        -> whether note's pitch class is in mask
+#   POPCOUNT[mask]              -> number of pitch classes in mask
+#   NOTE_BITS[note]             -> the single-bit set of a MIDI note
+#
+# The tables are numpy arrays so they also work on arrays of notes/masks.
+
+PITCH_CLASSES = 12
+ALL = (1 << PITCH_CLASSES) - 1
+
+NOTE_BITS = 1 << (np.arange(128) % PITCH_CLASSES)
+POPCOUNT = np.array([bin(mask).count('1') for mask in range(ALL + 1)])
+
+def pcs_of(notes):
+    mask = 0
+    for note in notes:
+        mask |= 1 << (note % PITCH_CLASSES)
+    return mask
+
+def contains(mask, note):
+    return (mask >> (note % PITCH_CLASSES)) & 1
+
+# Sets of MIDI notes (eg a part's range) as 128-bit Python ints, bit n for
+# note n.
+def notes_mask(notes):
+    mask = 0
+    for note in notes:
+        mask |= 1 << note
+    return mask
+
+def in_notes(mask, note):
+    return note >= 0 and (mask >> note) & 1
@@ -0,0 +1,260 @@
+import tempfile
+
+import numpy as np
+
+from beat import Beat, EMPTY, BITS, MANUAL, PARTS, REST, as_beat, decode
+from cache import LRUCache
+
+# Columnar storage for the beats of a session (BeatManager.data). It acts
+# like a list of Beats, but every key of a beat is kept in a fixed-width
+# array column:
+#
+#   present[i]           : bitmask (beat.BITS) of the keys beat i has
+#   manual[i]            : bitmask of the keys in its 'manual'
+#   harmony[i]           : index of its harmony in harmonies
+#   spacing[i], dissonance[i]
+#   lengths[i, p]        : number of subdivisions of part p's notes
+#   notes[i, p, :]       : the notes, with rests stored as beat.REST
+#   mel_length[i], mel_rhythm[i, :]
+#   acc_parts[i]         : bitmask of the parts in its 'acc_rhythm'
+#   acc_lengths[i, p], acc_rhythm[i, p, :]
+#                        : rhythms, with True / False / -1 as 1 / 0 / -1
+#   overflow[i]          : offset of beat i in the overflow file, -1 unless
+#                          it doesn't fit the columns (more than SUBDIVISIONS
+#                          subdivisions, unknown keys)
+#
+# Only the latest capacity beats are held in memory, in a ring. Older beats
+# are spilled to a temporary file CHUNK at a time and read back a chunk at a
+# time when asked for, so memory stays flat however long the session runs.
+# Overflowing beats are appended to a second file in their beat.py encoding.
+# Beats read or written recently are cached.
+
+SUBDIVISIONS = 8
+CHUNK = 32
+CAPACITY = 256
+CACHE_SIZE = 64
+
+COLUMNS = [
+    ('present', np.uint16, ()),
+    ('manual', np.uint16, ()),
+    ('harmony', np.int16, ()),
+    ('spacing', np.float64, ()),
+    ('dissonance', np.float64, ()),
+    ('lengths', np.uint8, (len(PARTS),)),
+    ('notes', np.int8, (len(PARTS), SUBDIVISIONS)),
+    ('mel_length', np.uint8, ()),
+    ('mel_rhythm', np.int8, (SUBDIVISIONS,)),
+    ('acc_parts', np.uint8, ()),
+    ('acc_lengths', np.uint8, (len(PARTS),)),
+    ('acc_rhythm', np.int8, (len(PARTS), SUBDIVISIONS)),
+    ('overflow', np.int64, ()),
+    ('overflow_length', np.int32, ()),
+]
+ROW_BYTES = sum(np.dtype(dtype).itemsize * int(np.prod(shape)) for name, dtype, shape in COLUMNS)
+
+def _is_note(note):
+    return note is None or isinstance(note, (int, long, np.integer)) and -1 <= note <= 127
+
+def _is_rhythm(rhythm):
+    return len(rhythm) <= SUBDIVISIONS and all(value in (True, False, -1) for value in rhythm)
+
+# whether beat can be stored in the columns rather than the overflow file
+def fits(beat):
+    if any(key not in BITS for key in beat) or any(key not in BITS for key in beat.get('manual', ())):
+        return False
+    if 'harmony' in beat and not isinstance(beat['harmony'], str):
+        return False
+    for key in ('spacing', 'dissonance'):
+        if key in beat and not isinstance(beat[key], (int, long, float)):
+            return False
+    for part in PARTS:
+        notes = beat.get(part, ())
+        if len(notes) > SUBDIVISIONS or not all(_is_note(note) for note in notes):
+            return False
+    acc_rhythm = beat.get('acc_rhythm', {})
+    if any(part not in PARTS for part in acc_rhythm):
+        return False
+    return _is_rhythm(beat.get('mel_rhythm', ())) and all(_is_rhythm(rhythm) for rhythm in acc_rhythm.values())
+
+def _rhythm_codes(rhythm):
+    return [-1 if value == -1 else 1 if value else 0 for value in rhythm]
+
+def _rhythm(codes):
+    return tuple(-1 if code == -1 else code == 1 for code in codes)
+
+
+class ScoreStore(object):
+    def __init__(self, beats=(), capacity=CAPACITY, directory=None):
+        super(ScoreStore, self).__init__()
+        # whole chunks, so a chunk never wraps around the ring
+        self.capacity = max(CHUNK, capacity // CHUNK * CHUNK)
+        self.columns = {
+            name: np.zeros((self.capacity,) + shape, dtype)
+            for name, dtype, shape in COLUMNS
+        }
+        self.length = 0
+        self.base = 0 # first beat held in memory
+
+        self.harmonies = []
+        self.harmony_ids = {}
+
+        self.spill = tempfile.TemporaryFile(dir=directory)
+        self.spilled = None # (chunk, columns) last read back from spill
+        self.overflow = tempfile.TemporaryFile(dir=directory)
+        self.overflow_end = 0
+        self.cache = LRUCache(CACHE_SIZE)
+
+        self.extend(beats)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self._get(index) for index in range(*key.indices(self.length))]
+        return self._get(self._index(key))
+
+    def __setitem__(self, key, beat):
+        index = self._index(key)
+        beat = as_beat(beat)
+        chunk, columns, row = self._locate(index)
+        self._write(columns, row, beat)
+        if chunk is not None:
+            self._store_chunk(chunk, columns)
+        self.cache.put(index, beat)
+
+    def __iadd__(self, beats):
+        self.extend(beats)
+        return self
+
+    def append(self, beat):
+        if self.length - self.base == self.capacity:
+            self._spill_oldest()
+        self.length += 1
+        self[self.length - 1] = beat
+
+    def extend(self, beats):
+        for beat in beats:
+            self.append(beat)
+
+    def _index(self, index):
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('beat index out of range')
+        return index
+
+    def _get(self, index):
+        beat = self.cache.get(index)
+        if beat is None:
+            chunk, columns, row = self._locate(index)
+            beat = self._read(columns, row)
+            self.cache.put(index, beat)
+        return beat
+
+    # (spilled chunk or None, columns, row) where beat index is stored
+    def _locate(self, index):
+        if index >= self.base:
+            return None, self.columns, index % self.capacity
+        chunk = index // CHUNK
+        return chunk, self._load_chunk(chunk), index % CHUNK
+
+    def _spill_oldest(self):
+        start = self.base % self.capacity
+        self._store_chunk(self.base // CHUNK, {
+            name: column[start:start + CHUNK]
+            for name, column in self.columns.items()
+        })
+        self.base += CHUNK
+
+    def _store_chunk(self, chunk, columns):
+        self.spill.seek(chunk * CHUNK * ROW_BYTES)
+        self.spill.write(''.join(columns[name].tobytes() for name, dtype, shape in COLUMNS))
+
+    def _load_chunk(self, chunk):
+        if self.spilled is not None and self.spilled[0] == chunk:
+            return self.spilled[1]
+        self.spill.seek(chunk * CHUNK * ROW_BYTES)
+        data = self.spill.read(CHUNK * ROW_BYTES)
+        columns = {}
+        offset = 0
+        for name, dtype, shape in COLUMNS:
+            count = CHUNK * int(np.prod(shape))
+            columns[name] = np.frombuffer(data, dtype, count, offset).reshape((CHUNK,) + shape).copy()
+            offset += count * np.dtype(dtype).itemsize
+        self.spilled = (chunk, columns)
+        return columns
+
+    def _harmony_id(self, harmony):
+        if harmony not in self.harmony_ids:
+            self.harmony_ids[harmony] = len(self.harmonies)
+            self.harmonies.append(harmony)
+        return self.harmony_ids[harmony]
+
+    def _write(self, columns, row, beat):
+        for name, dtype, shape in COLUMNS:
+            columns[name][row] = 0
+        columns['overflow'][row] = -1
+        if not fits(beat):
+            encoded = beat.encode()
+            self.overflow.seek(self.overflow_end)
+            self.overflow.write(encoded)
+            columns['overflow'][row] = self.overflow_end
+            columns['overflow_length'][row] = len(encoded)
+            self.overflow_end += len(encoded)
+            return
+
+        columns['present'][row] = sum(BITS[key] for key in beat)
+        columns['manual'][row] = sum(BITS[key] for key in beat.get('manual', ()))
+        if 'harmony' in beat:
+            columns['harmony'][row] = self._harmony_id(beat['harmony'])
+        columns['spacing'][row] = beat.get('spacing', 0.)
+        columns['dissonance'][row] = beat.get('dissonance', 0.)
+        for k, part in enumerate(PARTS):
+            notes = beat.get(part, ())
+            columns['lengths'][row, k] = len(notes)
+            columns['notes'][row, k, :len(notes)] = [REST if note is None else note for note in notes]
+        mel_rhythm = beat.get('mel_rhythm', ())
+        columns['mel_length'][row] = len(mel_rhythm)
+        columns['mel_rhythm'][row, :len(mel_rhythm)] = _rhythm_codes(mel_rhythm)
+        acc_rhythm = beat.get('acc_rhythm', {})
+        columns['acc_parts'][row] = sum(BITS[part] for part in acc_rhythm)
+        for k, part in enumerate(PARTS):
+            rhythm = acc_rhythm.get(part, ())
+            columns['acc_lengths'][row, k] = len(rhythm)
+            columns['acc_rhythm'][row, k, :len(rhythm)] = _rhythm_codes(rhythm)
+
+    def _read(self, columns, row):
+        offset = int(columns['overflow'][row])
+        if offset >= 0:
+            self.overflow.seek(offset)
+            return decode(self.overflow.read(int(columns['overflow_length'][row])))
+        present = int(columns['present'][row])
+        if not present:
+            return EMPTY
+
+        items = {}
+        lengths = columns['lengths'][row].tolist()
+        notes = columns['notes'][row].tolist()
+        for k, part in enumerate(PARTS):
+            if present & BITS[part]:
+                items[part] = tuple(None if note == REST else note for note in notes[k][:lengths[k]])
+        if present & BITS['harmony']:
+            items['harmony'] = self.harmonies[columns['harmony'][row]]
+        for key in ('spacing', 'dissonance'):
+            if present & BITS[key]:
+                items[key] = float(columns[key][row])
+        if present & BITS['manual']:
+            items['manual'] = MANUAL[int(columns['manual'][row])]
+        if present & BITS['mel_rhythm']:
+            items['mel_rhythm'] = _rhythm(columns['mel_rhythm'][row, :columns['mel_length'][row]].tolist())
+        if present & BITS['acc_rhythm']:
+            parts = int(columns['acc_parts'][row])
+            lengths = columns['acc_lengths'][row].tolist()
+            rhythms = columns['acc_rhythm'][row].tolist()
+            items['acc_rhythm'] = {
+                part: _rhythm(rhythms[k][:lengths[k]])
+                for k, part in enumerate(PARTS)
+                if parts & BITS[part]
+            }
+        return Beat(items)
@@ -0,0 +1,112 @@
+import json
+import time
+
+# Hot-path stage timers. Code marks a stage with start(name) / stop(name);
+# while enabled, every stop adds the elapsed nanoseconds to that stage's
+# count, total, max and a log2 histogram. While disabled, start and stop
+# only test a flag, so the hooks can stay in the beat-critical path.
+#
+#   stages[name] : [count, total ns, max ns, histogram]
+#
+# histogram[b] counts the durations d with 2**(b - 1) <= d < 2**b ns.
+
+HISTOGRAM_BUCKETS = 48
+
+enabled = False
+stages = {}
+_started = {}
+
+def enable(on=True):
+    global enabled
+    enabled = on
+    _started.clear()
+
+def start(stage):
+    if enabled:
+        _started[stage] = time.time()
+
+def stop(stage):
+    if enabled and stage in _started:
+        record(stage, int((time.time() - _started.pop(stage)) * 1e9))
+
+def record(stage, ns):
+    entry = stages.get(stage)
+    if entry is None:
+        entry = stages[stage] = [0, 0, 0, [0] * HISTOGRAM_BUCKETS]
+    ns = max(ns, 0)
+    entry[0] += 1
+    entry[1] += ns
+    entry[2] = max(entry[2], ns)
+    entry[3][min(ns.bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+
+def reset():
+    stages.clear()
+
+# Takes the counters accumulated so far and clears them. Worker processes
+# send these to the parent, which merges them into its own.
+def collect():
+    snapshot = dict(stages)
+    stages.clear()
+    return snapshot
+
+def merge(snapshot):
+    for stage, (count, total, longest, histogram) in snapshot.items():
+        entry = stages.get(stage)
+        if entry is None:
+            stages[stage] = [count, total, longest, list(histogram)]
+            continue
+        entry[0] += count
+        entry[1] += total
+        entry[2] = max(entry[2], longest)
+        entry[3] = [a + b for a, b in zip(entry[3], histogram)]
+
+# upper bound, in ns, of the histogram bucket holding the q quantile
+# (so percentiles are only accurate to a factor of 2)
+def percentile(histogram, q):
+    target = q * sum(histogram)
+    seen = 0
+    for bucket, count in enumerate(histogram):
+        seen += count
+        if count and seen >= target:
+            return 2 ** bucket
+    return 0
+
+def summary():
+    return {
+        stage: {
+            'count': count,
+            'total_ms': total / 1e6,
+            'mean_us': total / 1e3 / count,
+            'p50_us': min(percentile(histogram, .5), longest) / 1e3,
+            'p90_us': min(percentile(histogram, .9), longest) / 1e3,
+            'p99_us': min(percentile(histogram, .99), longest) / 1e3,
+            'max_us': longest / 1e3,
+        }
+        for stage, (count, total, longest, histogram) in stages.items()
+        if count
+    }
+
+def report_text():
+    lines = ['{:<16} {:>8} {:>11} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'stage', 'count', 'total ms', 'mean us', 'p50 us', 'p90 us', 'p99 us', 'max us')]
+    for stage, row in sorted(summary().items(), key=lambda item: -item[1]['total_ms']):
+        lines.append('{:<16} {:>8} {:>11.3f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+            stage, row['count'], row['total_ms'], row['mean_us'],
+            row['p50_us'], row['p90_us'], row['p99_us'], row['max_us']))
+    return '\n'.join(lines)
+
+def report_json():
+    return json.dumps({
+        'summary': summary(),
+        'histograms': {
+            stage: entry[3]
+            for stage, entry in stages.items()
+        },
+    }, indent=2, sort_keys=True)
+
+# writes basename.txt and basename.json
+def export(basename='profile'):
+    with open(basename + '.txt', 'w') as f:
+        f.write(report_text() + '\n')
+    with open(basename + '.json', 'w') as f:
+        f.write(report_json() + '\n')
@@ -0,0 +1,198 @@
+import heapq
+import multiprocessing
+import Queue
+import traceback
+
+import autocomplete
+import timing
+from autocomplete import autocomplete_anytime, autocomplete_config
+from beat import Beat
+
+# number of slots in the shared table of job versions. Each beat with an
+# active job holds one until the job finishes or is cancelled, so this only
+# needs to cover the beats that can have a job in flight at once.
+VERSION_SLOTS = 256
+
+# Long-lived autocomplete processes. Each worker compiles the style tables
+# once at startup and then serves jobs until it receives None, so no
+# process is forked on the beat-critical path.
+def _worker(style, joint, jobs, results, versions, speculation, profiling, timings):
+    autocomplete_config(style)
+    autocomplete.joint_search = joint
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        beat_index, version, data, deadline, playback, seed, guess, slot = job
+        if timing.enabled != bool(profiling.value):
+            timing.enable(bool(profiling.value))
+
+        # a job is abandoned as soon as the parent supersedes or cancels it.
+        # Speculative jobs (with a guess) all go stale together.
+        if guess is None:
+            stale = lambda: versions[slot] != version
+        else:
+            stale = lambda: speculation.value != version
+        # a job that fails is reported as finished without a beat, so the
+        # worker lives on and the parent stops waiting for it
+        try:
+            for result, complete in autocomplete_anytime(data, deadline, playback, stale, seed, beat_index):
+                if stale():
+                    break
+                results.put((beat_index, version, Beat(result[1]), complete, guess))
+        except Exception:
+            print 'autocomplete failed for beat', beat_index
+            traceback.print_exc()
+            results.put((beat_index, version, None, True, guess))
+        if timing.stages:
+            timings.put(timing.collect())
+
+
+class AutocompletePool(object):
+    def __init__(self, style, num_workers=None, max_jobs=None, joint=False):
+        super(AutocompletePool, self).__init__()
+        if num_workers is None:
+            num_workers = max(1, multiprocessing.cpu_count() - 1)
+        if max_jobs is None:
+            max_jobs = num_workers
+
+        # Jobs wait here, ordered by beat index so the beat closest to the
+        # playhead goes first, until the bounded queue has room. Keeping the
+        # queue short keeps the ordering decisions on this side.
+        self.pending = []
+        self.jobs = multiprocessing.Queue(max_jobs)
+        self.results = multiprocessing.Queue()
+
+        # latest version of each beat's job. Results and queued jobs from
+        # older versions are stale and get dropped. Versions are numbered
+        # across all beats, so a slot handed from one beat to another
+        # always makes the old beat's job stale.
+        self.versions = multiprocessing.RawArray('i', VERSION_SLOTS)
+        self.version = 0
+        self.active = {}
+        self.slots = {}
+        self.free_slots = range(VERSION_SLOTS)
+
+        # Speculative jobs autocomplete a beat as if the user had entered a
+        # guessed input. They only run while no real job is waiting, and
+        # their results are kept in speculated[beat_index, guess key] until
+        # the next call to speculate() makes them all stale.
+        self.speculation = multiprocessing.RawValue('i', 0)
+        self.speculative = []
+        self.speculated = {}
+
+        # workers time their stages while this is set and send the counters
+        # back after each job, to be merged into this process's timing
+        self.profiling = multiprocessing.RawValue('b', 0)
+        self.timings = multiprocessing.Queue()
+
+        self.workers = []
+        for i in range(num_workers):
+            worker = multiprocessing.Process(target=_worker, args=(style, joint, self.jobs, self.results, self.versions, self.speculation, self.profiling, self.timings))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    # data is the window of beats to autocomplete, as a list of Beats: they
+    # are immutable, so the list itself is the snapshot, and each pickles to
+    # its compact encoding. deadline is when a first result is wanted and
+    # playback is the last moment an improved one is still useful, both as
+    # time.time() values (None for no limit). seed is the session seed the
+    # beat's random stream is derived from. Supersedes any earlier job for
+    # the same beat.
+    def submit(self, beat_index, data, deadline=None, playback=None, seed=None):
+        slot = self._slot(beat_index)
+        self.version += 1
+        self.versions[slot] = self.version
+        self.active[beat_index] = self.version
+        heapq.heappush(self.pending, (beat_index, self.version, data, deadline, playback, seed, None, slot))
+        self._flush()
+
+    # guesses is a list of (guess key, data) to autocomplete beat_index from,
+    # replacing any earlier speculation
+    def speculate(self, beat_index, guesses, seed=None):
+        self.speculation.value += 1
+        self.speculated = {}
+        self.speculative = [
+            (beat_index, self.speculation.value, data, None, None, seed, key, None)
+            for key, data in guesses
+        ][::-1]
+        self._flush()
+
+    # drop the beat's job whether it is queued, running or finished
+    def cancel(self, beat_index):
+        if beat_index in self.active:
+            self.versions[self.slots[beat_index]] = 0
+            self._finish(beat_index)
+
+    # beats whose job hasn't delivered a complete result yet
+    def active_beats(self):
+        return self.active.keys()
+
+    def set_profiling(self, on):
+        self.profiling.value = on
+        timing.enable(on)
+
+    # the beat's slot in versions, taking a free one if it has none
+    def _slot(self, beat_index):
+        if beat_index not in self.slots:
+            assert self.free_slots, 'more than VERSION_SLOTS beats autocompleting at once'
+            self.slots[beat_index] = self.free_slots.pop()
+        return self.slots[beat_index]
+
+    def _finish(self, beat_index):
+        del self.active[beat_index]
+        self.free_slots.append(self.slots.pop(beat_index))
+
+    def _flush(self):
+        while self.pending:
+            job = self.pending[0]
+            if self.active.get(job[0]) != job[1]:
+                heapq.heappop(self.pending)
+                continue
+            try:
+                self.jobs.put_nowait(job)
+            except Queue.Full:
+                return
+            heapq.heappop(self.pending)
+        while self.speculative and not self.active:
+            try:
+                self.jobs.put_nowait(self.speculative[-1])
+            except Queue.Full:
+                return
+            self.speculative.pop()
+
+    # call every frame. Returns every (beat_index, beat, complete) finished so
+    # far; a beat whose search was cut short may be followed by a better one.
+    def poll(self):
+        self._flush()
+        while True:
+            try:
+                timing.merge(self.timings.get_nowait())
+            except Queue.Empty:
+                break
+        results = []
+        while True:
+            try:
+                beat_index, version, beat, complete, guess = self.results.get_nowait()
+            except Queue.Empty:
+                return results
+            if guess is not None:
+                if version == self.speculation.value and beat is not None:
+                    self.speculated[beat_index, guess] = beat
+                continue
+            if self.active.get(beat_index) != version:
+                continue
+            if complete:
+                self._finish(beat_index)
+            if beat is not None:
+                results.append((beat_index, beat, complete))
+
+    def close(self):
+        self.pending = []
+        self.speculative = []
+        for worker in self.workers:
+            try:
+                self.jobs.put_nowait(None)
+            except Queue.Full:
+                worker.terminate()